@@ -1,97 +1,405 @@
 import asyncio
+import base64
 import copy
+import hashlib
 import json
 import logging
+import random
+import time
 import traceback
+from collections import OrderedDict, deque
 from typing import Optional
 
 import anthropic
 import html2text
+import httpx
 import openai
 
 import sql_worker
+import tokenizer
 import utils
 
 
 class ApiRequestException(Exception):
-    pass
+
+    def __init__(self, *args, kind='api_error', retryable=True, retry_after=None):
+        super().__init__(*args)
+        self.kind = kind
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class RetryPolicy:
+    """Decides whether a failed LLM request should be repeated and how long to wait before the next attempt."""
+
+    base_delay = 1
+    max_delay = 30
+    max_retry_after = 60
+
+    @staticmethod
+    def get_retry_after(exc) -> Optional[float]:
+        response = getattr(exc, 'response', None)
+        if response is None:
+            return None
+        for header, multiplier in (('retry-after-ms', 0.001), ('retry-after', 1)):
+            try:
+                return float(response.headers.get(header)) * multiplier
+            except (TypeError, ValueError):
+                continue
+        return None
+
+    def classify(self, exc) -> ApiRequestException:
+        """Wraps an SDK exception into ApiRequestException with the error kind and retry hints."""
+        if isinstance(exc, ApiRequestException):
+            return exc
+        if isinstance(exc, (openai.RateLimitError, anthropic.RateLimitError)):
+            kind, retryable = 'rate_limit', True
+        elif isinstance(exc, (openai.APITimeoutError, anthropic.APITimeoutError)):
+            kind, retryable = 'timeout', True
+        elif isinstance(exc, (openai.APIConnectionError, anthropic.APIConnectionError)):
+            kind, retryable = 'connection', True
+        elif isinstance(exc, (openai.APIStatusError, anthropic.APIStatusError)):
+            if exc.status_code >= 500 or exc.status_code in (408, 409):
+                kind, retryable = 'server_error', True
+            else:
+                # Bad key, unknown model, too long context and so on will not be fixed by a retry
+                kind, retryable = 'client_error', False
+        else:
+            kind, retryable = 'api_error', True
+        return ApiRequestException(Dialog.html_parser(exc), kind=kind, retryable=retryable,
+                                   retry_after=self.get_retry_after(exc))
+
+    def delay(self, attempt, exc: ApiRequestException):
+        if exc.retry_after is not None:
+            return min(exc.retry_after, self.max_retry_after)
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+class ClientPool:
+    """Process-wide registry of SDK clients. Dialogs with the same vendor, API key and base URL share one client
+    and therefore one HTTP connection pool. A client is closed when the last dialog using it releases it."""
+
+    def __init__(self, max_connections, max_keepalive_connections, keepalive_expiry):
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self.clients = {}
+        self.closing_tasks = set()
+
+    def acquire(self, vendor, api_key, base_url):
+        key = (vendor, api_key, base_url)
+        if key not in self.clients:
+            if vendor == 'anthropic':
+                client = anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url,
+                                                  http_client=anthropic.DefaultAsyncHttpxClient(limits=self.limits))
+            else:
+                client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url,
+                                            http_client=openai.DefaultAsyncHttpxClient(limits=self.limits))
+            self.clients[key] = [client, 0]
+        self.clients[key][1] += 1
+        return key, self.clients[key][0]
+
+    def release(self, key):
+        self.clients[key][1] -= 1
+        if self.clients[key][1] > 0:
+            return
+        client, _ = self.clients.pop(key)
+        task = asyncio.create_task(client.close())
+        self.closing_tasks.add(task)
+        task.add_done_callback(self.closing_tasks.discard)
+
+    async def close(self):
+        for client, _ in self.clients.values():
+            await client.close()
+        self.clients.clear()
+
 
 class Dialog:
 
     _chat_config: dict
 
-    def __init__(self, chat_id, global_config, sql_helper: sql_worker.SqlWorker):
-
-        try:
-            dialog_data = sql_helper.get_dialog_data(chat_id, global_config.chat_config_template)
-        except Exception as e:
-            dialog_data = []
-            logging.error(f"Error reading conversation information for chat ID {chat_id}! "
-                          f"Please check your database!")
-            logging.error(f"{e}\n{traceback.format_exc()}")
+    def __init__(self, chat_id, global_config, sql_helper: sql_worker.AsyncSqlWorker, client_pool: ClientPool,
+                 dialog_data, dialog_history, summary=None):
 
         try:
             self._chat_config = json.loads(dialog_data[1])
-        except (json.JSONDecodeError, TypeError):
+        except (json.JSONDecodeError, TypeError, IndexError):
             logging.error(f'Error reading chat parameters for chat ID {chat_id}! Default settings will be used.')
             logging.error(traceback.format_exc())
             self._chat_config = copy.deepcopy(global_config.chat_config_template)
 
+        self.config_normalized = False
         if global_config.chat_config_template.keys() != self._chat_config.keys():
             self._chat_config = self.config_normalizer(global_config.chat_config_template, self._chat_config)
+            self.config_normalized = True
 
-            try:
-                sql_helper.dialog_conf_update(self._chat_config, chat_id)
-            except Exception as e:
-                logging.error(f"Error writing chat configuration with ID {chat_id} "
-                              f"to the database after normalization!")
-                logging.error(f"{e}\n{traceback.format_exc()}")
-
-        self.summarizer_used = False
+        self.summarizer_task: Optional[asyncio.Task] = None
+        # Incremented when the history is replaced, so a summary made for an outdated history is discarded
+        self.history_version = 0
         self.threads_semaphore = asyncio.Semaphore(self._chat_config.get('threads_limit'))
         self.global_config = global_config
         self.sql_helper = sql_helper
         self.chat_id = chat_id
         self.memory_dump = None
-        self.dialog_history = []
+        self.last_ttft = None
+        self.retry_policy = RetryPolicy()
+        self.retry_stats = {'requests': 0, 'retries': 0, 'failures': 0, 'errors': {}}
+        # Vendor payloads of the messages with pictures, see build_payload
+        self.payload_cache = {}
+        # Tasks of the handlers using the dialog, the dialog cache does not evict it while they are running
+        self.holders = set()
+        # Messages waiting for the end of the coalescing window, see coalesce
+        self.coalesced_turns: Optional[list] = None
+        self.dialog_history = dialog_history
+        self.history_tokens = []
+        self.history_token_total = 0
+        # Ratio between the tokens reported by the API and the local estimate, corrects the estimator on the fly
+        self.token_ratio = 1.0
+        # Number of history messages already stored in the DB. If the stored prefix was changed,
+        # the next save rewrites the whole dialog instead of appending new messages.
+        self.saved_len = len(dialog_history)
+        self.history_rewritten = False
+        # Rolling summary of everything before dialog_history, stored separately from the messages
+        self.summary = summary
+        self.summary_tokens = 0
+        self.summary_changed = False
+
+        # Older versions kept the summary as the first two messages of the dialog
+        if (not summary and len(dialog_history) > 1 and dialog_history[0]['role'] == 'user'
+                and dialog_history[0]['content'] == self._chat_config.get('summariser_prompt')
+                and dialog_history[1]['role'] == 'assistant'):
+            self.summary = dialog_history[1]['content']
+            self.summary_changed = True
+            self.dialog_history = dialog_history[2:]
+            self.history_rewritten = True
 
-        if dialog_data and dialog_data[2]:
-            self.dialog_history = json.loads(dialog_data[2])
-            # Pictures saved in the database may cause problems when working without Vision
-            if not self._chat_config.get('vision'):
-                self.dialog_history = self.cleaning_images(self.dialog_history)
+        # Indexes of the history messages that still contain pictures, in ascending order
+        self.image_indexes = deque()
+        # Messages of the already saved part of the history changed in place, by their index
+        self.updated_messages = {}
+        self.recount_tokens()
+        # Pictures saved in the database may cause problems when working without Vision
+        if not self._chat_config.get('vision'):
+            self.prune_images(0)
         self.system_prompt = self._chat_config.get('system_prompt')
-        self.client = self.make_client()
+        self.client_pool = client_pool
+        self.client_key = None
+        self.client = None
+        self.make_client()
+
+    @classmethod
+    async def create(cls, chat_id, global_config, sql_helper: sql_worker.AsyncSqlWorker, client_pool: ClientPool):
+        try:
+            dialog_data = await sql_helper.get_dialog_data(chat_id, global_config.chat_config_template)
+            dialog_history = await sql_helper.get_messages(chat_id)
+            summary = await sql_helper.get_summary(chat_id)
+        except Exception as e:
+            dialog_data, dialog_history, summary = [], [], None
+            logging.error(f"Error reading conversation information for chat ID {chat_id}! "
+                          f"Please check your database!")
+            logging.error(f"{e}\n{traceback.format_exc()}")
+
+        dialog = cls(chat_id, global_config, sql_helper, client_pool, dialog_data, dialog_history, summary)
+        if dialog.config_normalized:
+            try:
+                await sql_helper.dialog_conf_update(dialog.chat_config, chat_id)
+            except Exception as e:
+                logging.error(f"Error writing chat configuration with ID {chat_id} "
+                              f"to the database after normalization!")
+                logging.error(f"{e}\n{traceback.format_exc()}")
+        return dialog
 
     def make_client(self):
-        api_key = self._chat_config.get('api_key')
-        base_url = self._chat_config.get('base_url')
-        vendor = self._chat_config.get('vendor')
-        if not api_key:
-            return None
-        if vendor == 'anthropic':
-            return anthropic.Anthropic(api_key=api_key, base_url=base_url)
-        else:
-            return openai.OpenAI(api_key=api_key, base_url=base_url)
+        old_key = self.client_key
+        self.client_key, self.client = None, None
+        if self._chat_config.get('api_key'):
+            self.client_key, self.client = self.client_pool.acquire(self._chat_config.get('vendor'),
+                                                                    self._chat_config.get('api_key'),
+                                                                    self._chat_config.get('base_url'))
+        if old_key:
+            self.client_pool.release(old_key)
+
+    def close(self):
+        if self.client_key:
+            self.client_pool.release(self.client_key)
+        self.client_key, self.client = None, None
 
-    def reset_dialog(self):
-        self.dialog_history = []
-        self.sql_helper.dialog_update([], self.chat_id)
+    async def reset_dialog(self):
+        self.set_summary(None)
+        self.set_history([])
+        await self.save_history()
+
+    @property
+    def token_estimator(self) -> tokenizer.TokenEstimator:
+        return tokenizer.get_estimator(self._chat_config.get('vendor'), self._chat_config.get('model'))
+
+    def recount_tokens(self):
+        estimator = self.token_estimator
+        self.history_tokens = [estimator.count_message(message) for message in self.dialog_history]
+        self.history_token_total = sum(self.history_tokens)
+        self.summary_tokens = sum(estimator.count_message(message) for message in self.summary_messages())
+        self.image_indexes = deque(index for index, message in enumerate(self.dialog_history)
+                                   if isinstance(message['content'], list))
+
+    def set_summary(self, summary):
+        self.summary = summary
+        self.summary_changed = True
+        estimator = self.token_estimator
+        self.summary_tokens = sum(estimator.count_message(message) for message in self.summary_messages())
+
+    def summary_messages(self):
+        if not self.summary:
+            return []
+        return [{"role": "user", "content": f'{self._chat_config.get("summariser_prompt")}'},
+                {"role": "assistant", "content": self.summary}]
+
+    def set_history(self, messages):
+        if messages is not self.dialog_history:
+            self.history_version += 1
+        self.dialog_history = messages
+        self.history_rewritten = True
+        self.updated_messages = {}
+        self.recount_tokens()
+
+    def append_history(self, messages):
+        estimator = self.token_estimator
+        for message in messages:
+            if isinstance(message['content'], list):
+                self.image_indexes.append(len(self.dialog_history))
+            self.dialog_history.append(message)
+            self.history_tokens.append(estimator.count_message(message))
+            self.history_token_total += self.history_tokens[-1]
+
+    def prune_images(self, keep):
+        """Replaces pictures with their text in all messages except the last keep ones. Only the messages
+        that have left the window are visited. The list and the order of messages stay the same,
+        so a summary being prepared stays valid for the history."""
+        estimator = self.token_estimator
+        while self.image_indexes and self.image_indexes[0] < len(self.dialog_history) - keep:
+            index = self.image_indexes.popleft()
+            message = self.cleaning_images([self.dialog_history[index].copy()])[0]
+            self.dialog_history[index] = message
+            self.history_token_total -= self.history_tokens[index]
+            self.history_tokens[index] = estimator.count_message(message)
+            self.history_token_total += self.history_tokens[index]
+            if index < self.saved_len:
+                self.updated_messages[index] = message
+
+    def estimate_prompt_tokens(self, new_messages):
+        """Estimated size of the request with the current history and new messages, without calling the API."""
+        estimator = self.token_estimator
+        tokens = (self.summary_tokens + self.history_token_total
+                  + sum(estimator.count_message(message) for message in new_messages))
+        if self._chat_config.get('system_prompt'):
+            tokens += estimator.count_text(self._chat_config.get('system_prompt')) + estimator.message_overhead
+        return int(tokens * self.token_ratio)
+
+    def build_context(self, new_messages):
+        """Assembles the request under the context_limit token budget: the summary and new messages are always sent,
+        older turns are dropped from the beginning of the history, and only the most recent picture is kept.
+        Dropped messages stay in the history until the summarizer compresses them.
+        Returns the messages and their estimated size in tokens."""
+        estimator = self.token_estimator
+        image_kept = self.has_images(new_messages)
+        tokens = self.summary_tokens + sum(estimator.count_message(message) for message in new_messages)
+        if self._chat_config.get('system_prompt'):
+            tokens += estimator.count_text(self._chat_config.get('system_prompt')) + estimator.message_overhead
+        context_limit = self._chat_config.get('context_limit')
+        budget = context_limit / self.token_ratio if context_limit else float('inf')
+
+        context, context_tokens = [], []
+        start = len(self.dialog_history)
+        for index in range(len(self.dialog_history) - 1, -1, -1):
+            message = self.dialog_history[index]
+            message_tokens = self.history_tokens[index]
+            if isinstance(message['content'], list):
+                # Older pictures, or the latest one if it does not fit, are sent as their text only
+                if image_kept or tokens + message_tokens > budget:
+                    message = self.cleaning_images([message.copy()])[0]
+                    message_tokens = estimator.count_message(message)
+                image_kept = True
+            if tokens + message_tokens > budget:
+                break
+            tokens += message_tokens
+            context.append(message)
+            context_tokens.append(message_tokens)
+            start = index
+        context.reverse()
+        context_tokens.reverse()
+
+        # The context must start with a user message, otherwise some vendors reject the request
+        if start:
+            while context and context[0]['role'] != 'user':
+                tokens -= context_tokens.pop(0)
+                context.pop(0)
+                start += 1
+            logging.info(f"{start} old messages in chat ID {self.chat_id} do not fit into "
+                         f"the context limit and were not sent")
+        return self.summary_messages() + context + new_messages, int(tokens * self.token_ratio)
+
+    def calibrate_tokens(self, estimated_tokens, input_tokens):
+        if not estimated_tokens or not input_tokens:
+            return
+        ratio = input_tokens / (estimated_tokens / self.token_ratio)
+        self.token_ratio = min(max(self.token_ratio * 0.7 + ratio * 0.3, 0.5), 2.0)
+
+    async def save_history(self):
+        """Appends new messages to the DB, or rewrites the dialog if its already saved part has changed.
+        In write-behind mode the dialog is only marked as dirty and is saved later together with other chats."""
+        if self.sql_helper.write_behind:
+            self.sql_helper.mark_dirty(self)
+            return
+        changes = self.collect_changes()
+        if not changes:
+            return
+        try:
+            await self.sql_helper.save_dialogs([changes])
+        except Exception:
+            self.mark_unsaved()
+            raise
+
+    def mark_unsaved(self):
+        self.history_rewritten = True
+        self.summary_changed = True
+
+    def collect_changes(self):
+        # The state is captured before awaiting, so concurrent answers in the same chat do not write messages twice
+        history = self.dialog_history
+        saved_len, history_len, rewritten = self.saved_len, len(history), self.history_rewritten
+        summary = (self.summary or "") if self.summary_changed else None
+        updated = sorted(self.updated_messages.items())
+        self.saved_len, self.history_rewritten, self.summary_changed = history_len, False, False
+        self.updated_messages = {}
+        if rewritten:
+            return self.chat_id, history[:history_len], 0, True, summary, []
+        if history_len > saved_len or summary is not None or updated:
+            return self.chat_id, history[saved_len:history_len], saved_len, False, summary, updated
+        return None
 
     @property
     def chat_config(self):
         return self._chat_config
 
-    def set_chat_config(self, sql_helper, chat_config, msg_chat_id, param_name=None):
+    @property
+    def busy(self):
+        return (bool(self.holders) or self.threads_semaphore._value < self._chat_config.get('threads_limit')
+                or self.summarizing)
+
+    @property
+    def summarizing(self):
+        return self.summarizer_task is not None and not self.summarizer_task.done()
+
+    async def set_chat_config(self, sql_helper, chat_config, msg_chat_id, param_name=None):
         self._chat_config = chat_config
-        if not param_name:
-            self.cleaning_images(self.dialog_history)
-            self.client = self.make_client()
-        elif param_name == 'vision' and not chat_config.get('vision'):
-            self.cleaning_images(self.dialog_history)
-        elif param_name in ('vendor', 'api_key', 'base_url'):
-            self.client = self.make_client()
-        sql_helper.dialog_conf_update(chat_config, msg_chat_id)
+        if not param_name or (param_name == 'vision' and not chat_config.get('vision')):
+            if self.image_indexes:
+                self.prune_images(0)
+                await self.save_history()
+        if not param_name or param_name in ('vendor', 'api_key', 'base_url'):
+            self.make_client()
+        if not param_name or param_name in ('vendor', 'model'):
+            self.recount_tokens()
+        await sql_helper.dialog_conf_update(chat_config, msg_chat_id)
 
     @staticmethod
     def config_normalizer(global_config, chat_config):
@@ -114,36 +422,95 @@ class Dialog:
         text_converter.ignore_links = True
         return text_converter.handle(exc_text)
 
-    def send_api_request_openai(self, messages):
+    def log_first_token(self, start_time):
+        self.last_ttft = time.monotonic() - start_time
+        logging.info(f"Time to first token in chat ID {self.chat_id}: {self.last_ttft:.2f}s")
+
+    async def send_api_request_openai(self, messages, on_text=None):
 
         if self._chat_config.get('system_prompt'):
             system = [{"role": "system", "content": self._chat_config.get('system_prompt')}]
             system.extend(messages)
             messages = system
 
+        kwargs = {
+            'model': self._chat_config.get('model'),
+            'messages': messages,
+            'temperature': self._chat_config.get('temperature'),
+            'max_tokens': self._chat_config.get('tokens_per_answer'),
+            'timeout': 180
+        }
+        # OpenAI caches long prompt prefixes automatically, the key routes requests of one chat to the same cache
+        if self._chat_config.get('prompt_caching'):
+            kwargs['prompt_cache_key'] = f"aitronic-{self.chat_id}"
+
         completion = 'The "completion" object was not received.'
+        if on_text is None:
+            try:
+                completion = await self.client.chat.completions.create(stream=False, **kwargs)
+                answer = completion.choices[0].message.content
+                if not answer or answer.isspace():
+                    raise ApiRequestException("Empty text result!", kind="empty_answer")
+                return (answer, completion.usage.total_tokens, completion.usage.prompt_tokens,
+                        completion.usage.completion_tokens, self.openai_cached_tokens(completion.usage))
+            except Exception as e:
+                logging.error(f"OPENAI API REQUEST ERROR!\n{self.html_parser(e)}")
+                if self.global_config.full_debug:
+                    logging.error(traceback.format_exc())
+                    logging.error(completion)
+                raise self.retry_policy.classify(e)
+
         try:
-            completion = self.client.chat.completions.create(
-                model=self._chat_config.get('model'),
-                messages=messages,
-                temperature=self._chat_config.get('temperature'),
-                max_tokens=self._chat_config.get('tokens_per_answer'),
-                stream=False,
-                timeout=180
-            )
-            answer = completion.choices[0].message.content
+            start_time = time.monotonic()
+            answer = ""
+            usage = None
+            completion = await self.client.chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, **kwargs)
+            async for chunk in completion:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if not answer:
+                    self.log_first_token(start_time)
+                answer += chunk.choices[0].delta.content
+                await on_text(answer)
             if not answer or answer.isspace():
-                raise ApiRequestException("Empty text result!")
-            return (answer, completion.usage.total_tokens,
-                    completion.usage.prompt_tokens, completion.usage.completion_tokens)
+                raise ApiRequestException("Empty text result!", kind="empty_answer")
+            if not usage:
+                return answer, 0, 0, 0, 0
+            return (answer, usage.total_tokens, usage.prompt_tokens, usage.completion_tokens,
+                    self.openai_cached_tokens(usage))
         except Exception as e:
             logging.error(f"OPENAI API REQUEST ERROR!\n{self.html_parser(e)}")
             if self.global_config.full_debug:
                 logging.error(traceback.format_exc())
                 logging.error(completion)
-            raise ApiRequestException(self.html_parser(e))
+            raise self.retry_policy.classify(e)
+
+    @staticmethod
+    def openai_cached_tokens(usage):
+        details = getattr(usage, 'prompt_tokens_details', None)
+        return getattr(details, 'cached_tokens', None) or 0
+
+    @staticmethod
+    def anthropic_input_tokens(usage):
+        """Anthropic does not include cached tokens in input_tokens, returns the full input and its cached part."""
+        cache_read = getattr(usage, 'cache_read_input_tokens', None) or 0
+        cache_creation = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        return usage.input_tokens + cache_read + cache_creation, cache_read
+
+    @staticmethod
+    def mark_cache_breakpoint(message):
+        """Returns a copy of the message with cache_control on its last content block."""
+        content = message['content']
+        if isinstance(content, list):
+            content = content[:-1] + [dict(content[-1], cache_control={"type": "ephemeral"})]
+        else:
+            content = [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+        return dict(message, content=content)
 
-    def send_api_request_anthropic(self, messages):
+    async def send_api_request_anthropic(self, messages, on_text=None):
 
         completion = 'The "completion" object was not received.'
 
@@ -158,106 +525,186 @@ class Dialog:
         if self._chat_config.get('system_prompt'):
             kwargs.update({'system': self._chat_config.get('system_prompt')})
 
-        # Repackaging the OpenAI API format into an Anthropic API on the fly
-        for message in messages:
-            if isinstance(message['content'], list):
-                mime_type, base64_str, photo_text = '', '', ''
-                for content_part in message['content']:
-                    if content_part['type'] == 'text':
-                        photo_text = content_part['text']
-                    elif content_part['type'] == 'image_url':
-                        mime_type, base64_str = content_part['image_url']['url'].split(";base64,")
-                        mime_type = mime_type.split(":")[1]
-                message.update({
-                    'content': [
-                        {"type": "image", "source":
-                            {"type": "base64", "media_type": mime_type, "data": base64_str}},
-                        {"type": "text", "text": photo_text}]
-                })
-
-        if not self._chat_config.get('stream'):
+        # The system prompt and the history up to the last user message are the same in the next request,
+        # so they are marked for caching on the Anthropic side
+        if self._chat_config.get('prompt_caching'):
+            if kwargs.get('system'):
+                kwargs['system'] = [{"type": "text", "text": kwargs['system'], "cache_control": {"type": "ephemeral"}}]
+            user_indexes = [index for index, message in enumerate(messages) if message['role'] == 'user']
+            if user_indexes:
+                messages = messages.copy()
+                messages[user_indexes[-1]] = self.mark_cache_breakpoint(messages[user_indexes[-1]])
+                kwargs['messages'] = messages
+
+        if on_text is None:
             kwargs.update({'stream': False})
             try:
-                completion = self.client.messages.create(**kwargs)
+                completion = await self.client.messages.create(**kwargs)
                 if "error" in completion.id:
                     raise ApiRequestException(completion.content[0].text)
                 text = completion.content[0].text
                 if not text or text.isspace():
-                    raise ApiRequestException("Empty text result, please check your prefill!")
+                    raise ApiRequestException("Empty text result, please check your prefill!", kind="empty_answer")
                 while text[0] in (" ", "\n"):  # Sometimes Anthropic spits out spaces and line breaks
                     text = text[1::]  # at the beginning of text
-                return (text, completion.usage.input_tokens + completion.usage.output_tokens,
-                        completion.usage.input_tokens, completion.usage.output_tokens)
+                input_count, cached_count = self.anthropic_input_tokens(completion.usage)
+                return (text, input_count + completion.usage.output_tokens,
+                        input_count, completion.usage.output_tokens, cached_count)
             except Exception as e:
                 logging.error(f"ANTHROPIC API REQUEST ERROR!\n{self.html_parser(e)}")
                 if self.global_config.full_debug:
                     logging.error(traceback.format_exc())
                     logging.error(completion)
-                raise ApiRequestException(self.html_parser(e))
+                raise self.retry_policy.classify(e)
 
         try:
+            start_time = time.monotonic()
             input_count = 0
+            cached_count = 0
             output_count = 0
             text = ""
-            with self.client.messages.stream(**kwargs) as stream:
+            async with self.client.messages.stream(**kwargs) as stream:
                 empty_stream = True
                 error = False
-                for event in stream:
+                async for event in stream:
                     empty_stream = False
-                    name = event.__class__.__name__
-                    if name == "MessageStartEvent":
+                    if event.type == "message_start":
                         if event.message.usage:
-                            input_count += event.message.usage.input_tokens
+                            input_count, cached_count = self.anthropic_input_tokens(event.message.usage)
                         else:
                             error = True
-                    elif name == "ContentBlockDeltaEvent":
+                    elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+                        if not text:
+                            self.log_first_token(start_time)
                         text += event.delta.text
-                    elif name == "MessageDeltaEvent":
+                        # Leading spaces and line breaks are cut off, as in the final answer
+                        if text.lstrip(" \n"):
+                            await on_text(text.lstrip(" \n"))
+                    elif event.type == "message_delta":
                         output_count += event.usage.output_tokens
-                    elif name == "Error":
+                    elif event.type == "error":
                         raise ApiRequestException(event.error.message)
                 if empty_stream:
-                    raise ApiRequestException("Empty stream object, please check your proxy connection!")
+                    raise ApiRequestException("Empty stream object, please check your proxy connection!",
+                                              kind="empty_answer")
                 if error:
                     raise ApiRequestException(text)
                 if not text or text.isspace():
-                    raise ApiRequestException("Empty text result, please check your prefill!")
+                    raise ApiRequestException("Empty text result, please check your prefill!", kind="empty_answer")
             while text[0] in (" ", "\n"):
                 text = text[1::]
-            return text, input_count + output_count, input_count, output_count
+            return text, input_count + output_count, input_count, output_count, cached_count
         except Exception as e:
             logging.error(f"ANTHROPIC API REQUEST ERROR!\n{self.html_parser(e)}")
             if self.global_config.full_debug:
                 logging.error(traceback.format_exc())
                 logging.error(completion)
-            raise ApiRequestException(self.html_parser(e))
+            raise self.retry_policy.classify(e)
 
-    async def send_api_request(self, messages):
+    async def send_api_request(self, messages, on_text=None):
+        if not self.client:
+            # The dialog could be evicted from the cache while the handler was preparing the request
+            self.make_client()
         attempts = self._chat_config.get('attempts')
         if self._chat_config.get('vendor') == 'anthropic':
             func = self.send_api_request_anthropic
         else:
             func = self.send_api_request_openai
+        self.retry_stats['requests'] += 1
         for attempt in range(attempts):
             try:
-                return await asyncio.get_running_loop().run_in_executor(None, func, messages)
+                return await func(messages, on_text)
             except ApiRequestException as e:
-                if attempt + 1 == attempts:
+                self.retry_stats['errors'][e.kind] = self.retry_stats['errors'].get(e.kind, 0) + 1
+                if attempt + 1 == attempts or not e.retryable:
+                    self.retry_stats['failures'] += 1
                     raise e
-                continue
+                delay = self.retry_policy.delay(attempt, e)
+                self.retry_stats['retries'] += 1
+                logging.warning(f"LLM request in chat ID {self.chat_id} failed ({e.kind}), "
+                                f"attempt {attempt + 2} of {attempts} in {delay:.1f}s")
+                await asyncio.sleep(delay)
         return None
 
     @staticmethod
-    def get_image_context(photo_base64, prompt):
+    def get_image_context(image, prompt):
         return [
             {"type": "text", "text": prompt},
-            {"type": "image_url", "image_url": {"url": f"data:{photo_base64['mime']};base64,{photo_base64['data']}"}}
+            {"type": "image", "image": image}
         ]
 
-    async def get_answer(self, message, reply_msg: Optional[dict], photo_base64):
-        await self.threads_semaphore.acquire()
-        username = utils.username_parser(message)
-        chat_name = f"{username}'s private messages" if message.chat.title is None else f'chat {message.chat.title}'
+    async def store_image(self, photo_base64):
+        """Saves the picture to the blob store. The dialog history keeps only a reference to it."""
+        data = base64.b64decode(photo_base64['data'])
+        image_hash = hashlib.sha256(data).hexdigest()
+        await self.sql_helper.save_image(image_hash, photo_base64['mime'], data)
+        return {"hash": image_hash, "mime": photo_base64['mime']}
+
+    def image_part(self, mime, data):
+        data = base64.b64encode(data).decode('utf-8')
+        if self._chat_config.get('vendor') == 'anthropic':
+            return {"type": "image", "source": {"type": "base64", "media_type": mime, "data": data}}
+        return {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{data}"}}
+
+    def legacy_image_part(self, part):
+        """Pictures of older versions were kept in the OpenAI format, which Anthropic rejects."""
+        if self._chat_config.get('vendor') != 'anthropic':
+            return part.copy()
+        url = part['image_url']['url']
+        header, _, data = url.partition(',')
+        if header.startswith('data:') and header.endswith(';base64'):
+            return {"type": "image", "source": {"type": "base64", "media_type": header[5:-7], "data": data}}
+        return {"type": "image", "source": {"type": "url", "url": url}}
+
+    async def build_payload(self, messages):
+        """Converts messages from the internal format to the format of the chat vendor. Text messages are the same
+        in both formats and are passed as is, messages with pictures are converted once and then taken from the cache.
+        The history itself is never changed."""
+        vendor = self._chat_config.get('vendor')
+        payload_cache = {}
+        missing = []
+        for message in messages:
+            if not isinstance(message['content'], list):
+                continue
+            # Cleaning pictures replaces the content of the message, so the cached payload is checked against it
+            cached = self.payload_cache.get(id(message))
+            if cached and cached[0] is message and cached[1] is message['content'] and cached[2] == vendor:
+                payload_cache[id(message)] = cached
+            else:
+                missing.append(message)
+
+        hashes = {part['image']['hash'] for message in missing
+                  for part in message['content'] if part['type'] == 'image'}
+        images = {}
+        if hashes:
+            try:
+                images = await self.sql_helper.get_images(hashes)
+            except Exception as e:
+                logging.error(f"Error reading pictures from the database!\n{e}\n{traceback.format_exc()}")
+
+        for message in missing:
+            text_parts, image_parts = [], []
+            for part in message['content']:
+                if part['type'] == 'image_url':
+                    image_parts.append(self.legacy_image_part(part))
+                elif part['type'] != 'image':
+                    text_parts.append(part.copy())
+                elif part['image']['hash'] in images:
+                    image_parts.append(self.image_part(*images[part['image']['hash']]))
+                else:
+                    logging.warning(f"Picture {part['image']['hash']} was not found in the database "
+                                    f"and will not be sent to the LLM")
+            # Anthropic recommends placing pictures before the text
+            content = image_parts + text_parts if vendor == 'anthropic' else text_parts + image_parts
+            payload_cache[id(message)] = (message, message['content'], vendor,
+                                          {"role": message['role'], "content": content})
+
+        # Only the pictures of the last request are kept, the rest of the history is text and needs no conversion
+        self.payload_cache = payload_cache
+        return [payload_cache[id(message)][3] if isinstance(message['content'], list) else message
+                for message in messages]
+
+    def turn_text(self, message, reply_msg: Optional[dict], photo_base64):
         reply_msg_text = ""
         if reply_msg and self.dialog_history:
             # This cumbersome design allows not to clutter the dialog context
@@ -271,11 +718,50 @@ class Dialog:
 
         msg_txt = message.text or message.caption or utils.get_poll_text(message)
         if msg_txt is None:
-            msg_txt = "I sent a sticker" if photo_base64['mime'] == "image/webp" else "I sent a photo"
+            msg_txt = "I sent a sticker" if photo_base64 and photo_base64['mime'] == "image/webp" else "I sent a photo"
+        return f'{reply_msg_text}Message ({utils.username_parser(message)}): {msg_txt}'
 
-        main_text = f"Message ({username}): {msg_txt}"
-        dialog_buffer = self.dialog_history.copy()
-        prompt = f'{reply_msg_text}{main_text}'
+    async def coalesce(self, message, reply_msg: Optional[dict], photo_base64):
+        """Collects messages that arrive within coalesce_window seconds into one turn. The handler of the first
+        message waits for the window and gets the list of turns as (message, reply_msg, photo_base64),
+        the handlers of the other messages get None and do not answer."""
+        window = self._chat_config.get('coalesce_window')
+        if not window:
+            return [(message, reply_msg, photo_base64)]
+        if self.coalesced_turns is not None:
+            self.coalesced_turns.append((message, reply_msg, photo_base64))
+            return None
+        self.coalesced_turns = [(message, reply_msg, photo_base64)]
+        try:
+            await asyncio.sleep(window)
+        finally:
+            turns, self.coalesced_turns = self.coalesced_turns, None
+        if len(turns) > 1:
+            logging.info(f"{len(turns)} messages in chat ID {self.chat_id} were merged into one request")
+        return turns
+
+    async def get_answer(self, turns, on_text=None):
+        """turns is a list of (message, reply_msg, photo_base64) answered with one request, the answer is addressed
+        to the last message. on_text is an optional coroutine function that receives the partial answer
+        while it is being streamed."""
+        await self.threads_semaphore.acquire()
+        message = turns[-1][0]
+        username = utils.username_parser(message)
+        chat_name = f"{username}'s private messages" if message.chat.title is None else f'chat {message.chat.title}'
+        turn_text = "\n".join(self.turn_text(*turn) for turn in turns)
+        # Only one picture is sent with a turn, the latest one
+        photo_base64 = next((turn[2] for turn in reversed(turns) if turn[2]), None)
+
+        image = None
+        if photo_base64:
+            try:
+                image = await self.store_image(photo_base64)
+            except Exception as e:
+                self.threads_semaphore.release()
+                logging.error(f"{e}\n{traceback.format_exc()}")
+                raise ApiRequestException(f"ошибка сохранения изображения в БД\n{e}")
+
+        prompt = turn_text
 
         prefill_ass = None
         prefill_mode = self._chat_config.get('prefill_mode')
@@ -288,15 +774,23 @@ class Dialog:
             elif prefill_mode == 'post-user':
                 prompt = f"{prompt}\n{prefill_prompt}"
 
-        if photo_base64:
-            dialog_buffer.append({"role": "user", "content": self.get_image_context(photo_base64, prompt)})
-        else:
-            dialog_buffer.append({"role": "user", "content": prompt})
+        new_messages = [{"role": "user", "content": self.get_image_context(image, prompt) if image else prompt}]
         if prefill_ass:
-            dialog_buffer.append(prefill_ass)
+            new_messages.append(prefill_ass)
+
+        # Compaction starts in parallel with the request if the request is known to exceed the limit
+        estimated_tokens = self.estimate_prompt_tokens(new_messages)
+        if estimated_tokens >= self._chat_config.get('summarizer_limit'):
+            self.schedule_summarizer(chat_name, message)
+
+        history_version = self.history_version
+        dialog_buffer, context_tokens = self.build_context(new_messages)
 
         try:
-            answer, total_tokens, input_tokens, output_tokens = await self.send_api_request(dialog_buffer)
+            payload = await self.build_payload(dialog_buffer)
+            stream_callback = on_text if self._chat_config.get('stream_mode') else None
+            answer, total_tokens, input_tokens, output_tokens, cached_tokens = await self.send_api_request(
+                payload, stream_callback)
             if self.global_config.full_debug:
                 logging.info(f"--FULL DEBUG INFO FOR API REQUEST--\n\n{self.system_prompt}\n\n{dialog_buffer}"
                              f"\n\n{answer}\n\n--END OF FULL DEBUG INFO FOR API REQUEST--")
@@ -307,36 +801,28 @@ class Dialog:
                              f"\n\n--END OF FULL DEBUG INFO FOR API REQUEST--")
             raise ApiRequestException(f"ошибка запроса к LLM\n{e}")
 
-        logging.info(f'{total_tokens} tokens counted by the OpenAI API in {chat_name}.')
-        prompt = f'{reply_msg_text}{main_text}'
-        if photo_base64:
-            self.dialog_history.extend([{"role": "user", "content": self.get_image_context(photo_base64, prompt)},
-                                        {"role": "assistant", "content": answer}])
-        else:
-            self.dialog_history.extend([{"role": "user", "content": prompt},
-                                        {"role": "assistant", "content": answer}])
-        if self._chat_config.get('vision') and len(self.dialog_history) > 10:
-            self.dialog_history = self.cleaning_images(self.dialog_history, last_only=True)
-        if total_tokens >= self._chat_config.get('summarizer_limit') and not self.summarizer_used:
-            logging.info(f"The token limit {self._chat_config.get('summarizer_limit')} for "
-                         f"the {chat_name} has been exceeded. Using a lazy summarizer")
-            try:
-                await self.summarizer(chat_name)
-            except ApiRequestException as e:
-                message.reply(f"Ошибка суммарайзинга диалога: {e}.\nПросьба проверить логи бота!")
+        logging.info(f'{total_tokens} tokens counted by the OpenAI API in {chat_name}, '
+                     f'{cached_tokens} of {input_tokens} input tokens were read from the prompt cache.')
+        self.calibrate_tokens(context_tokens, input_tokens)
+        self.append_history([{"role": "user",
+                              "content": self.get_image_context(image, turn_text) if image else turn_text},
+                             {"role": "assistant", "content": answer}])
+        if self._chat_config.get('vision'):
+            self.prune_images(self._chat_config.get('images_window'))
+        if self.summarizer_needed(total_tokens, history_version):
+            self.schedule_summarizer(chat_name, message)
 
         if self._chat_config.get('show_used_tokens'):
-            answer = utils.token_counter_formatter(answer, total_tokens, input_tokens, output_tokens)
+            answer = utils.token_counter_formatter(answer, total_tokens, input_tokens, output_tokens,
+                                                   cached_tokens)
         try:
-            self.sql_helper.dialog_update(self.dialog_history, self.chat_id)
+            await self.save_history()
         except Exception as e:
             logging.error("AITronic was unable to save conversation information! Please check your database!")
             logging.error(f"{e}\n{traceback.format_exc()}")
-            message.reply(f"Ошибка записи ответа нейросети в БД: {e}.\n"
-                          f"Контекст разговора будет утрачен после перезапуска бота!")
+            await message.reply(f"Ошибка записи ответа нейросети в БД: {e}.\n"
+                                f"Контекст разговора будет утрачен после перезапуска бота!")
         self.threads_semaphore.release()
-        if self.threads_semaphore._value >= self._chat_config.get('threads_limit') and self.summarizer_used:
-            self.summarizer_used = False
         return answer
 
     async def get_answer_inline(self, username, msg_txt):
@@ -344,10 +830,11 @@ class Dialog:
         chat_name = f"{username}'s private messages"
 
         main_text = f"Message ({username}): {msg_txt}"
-        dialog_buffer = self.dialog_history.copy()
-        dialog_buffer.append({"role": "user", "content": main_text})
+        history_version = self.history_version
+        dialog_buffer, context_tokens = self.build_context([{"role": "user", "content": main_text}])
         try:
-            answer, total_tokens, input_tokens, output_tokens = await self.send_api_request(dialog_buffer)
+            payload = await self.build_payload(dialog_buffer)
+            answer, total_tokens, input_tokens, output_tokens, cached_tokens = await self.send_api_request(payload)
             if self.global_config.full_debug:
                 logging.info(f"--FULL DEBUG INFO FOR API REQUEST--\n\n{self.system_prompt}\n\n{dialog_buffer}"
                              f"\n\n{answer}\n\n--END OF FULL DEBUG INFO FOR API REQUEST--")
@@ -368,79 +855,100 @@ class Dialog:
                 answer = answer[:-1]
             answer = answer[:-1]
 
-        logging.info(f'{total_tokens} tokens counted by the OpenAI API in {chat_name}.')
-        self.dialog_history.extend([{"role": "user", "content": main_text},
-                                    {"role": "assistant", "content": answer}])
-        if self._chat_config.get('vision') and len(self.dialog_history) > 10:
-            self.dialog_history = self.cleaning_images(self.dialog_history, last_only=True)
-        if total_tokens >= self._chat_config.get('summarizer_limit') and not self.summarizer_used:
-            logging.info(f"The token limit {self._chat_config.get('summarizer_limit')} for "
-                         f"the {chat_name} has been exceeded. Using a lazy summarizer")
-            try:
-                await self.summarizer(chat_name)
-            except ApiRequestException:
-                pass
+        logging.info(f'{total_tokens} tokens counted by the OpenAI API in {chat_name}, '
+                     f'{cached_tokens} of {input_tokens} input tokens were read from the prompt cache.')
+        self.calibrate_tokens(context_tokens, input_tokens)
+        self.append_history([{"role": "user", "content": main_text},
+                             {"role": "assistant", "content": answer}])
+        if self._chat_config.get('vision'):
+            self.prune_images(self._chat_config.get('images_window'))
+        if self.summarizer_needed(total_tokens, history_version):
+            self.schedule_summarizer(chat_name)
 
         if self._chat_config.get('show_used_tokens'):
-            answer = utils.token_counter_formatter(answer, total_tokens, input_tokens, output_tokens)
+            answer = utils.token_counter_formatter(answer, total_tokens, input_tokens, output_tokens,
+                                                   cached_tokens)
         try:
-            self.sql_helper.dialog_update(self.dialog_history, self.chat_id)
+            await self.save_history()
         except Exception as e:
             logging.error("AITronic was unable to save conversation information! Please check your database!")
             logging.error(f"{e}\n{traceback.format_exc()}")
             pass
 
         self.threads_semaphore.release()
-        if self.threads_semaphore._value >= self._chat_config.get('threads_limit') and self.summarizer_used:
-            self.summarizer_used = False
         return answer
 
+    @staticmethod
+    def has_images(dialog):
+        return any(isinstance(message['content'], list) for message in dialog)
+
     # This code clears the context from old images so that they do not cause problems in operation
     # noinspection PyTypeChecker
     @staticmethod
-    def cleaning_images(dialog, last_only=False):
-
-        def cleaner():
-            if isinstance(dialog[index]['content'], list):
-                for i in dialog[index]['content']:
+    def cleaning_images(dialog):
+        for message in dialog:
+            if isinstance(message['content'], list):
+                for i in message['content']:
                     if i['type'] == 'text':
-                        dialog[index]['content'] = i['text']
-
-        if last_only:
-            for index in range(len(dialog) - 11, -1, -1):
-                cleaner()
-        else:
-            for index in range(len(dialog)):
-                cleaner()
+                        message['content'] = i['text']
         return dialog
 
-    def summarizer_index(self, threshold=None):
-        text_len = 0
-        for index in range(len(self.dialog_history)):
-            if isinstance(self.dialog_history[index]['content'], list):
-                for i in self.dialog_history[index]['content']:
-                    if i['type'] == 'text':
-                        text_len += len(i['text'])
-            else:
-                text_len += len(self.dialog_history[index]['content'])
-
-            if threshold:
-                if text_len >= threshold and self.dialog_history[index]['role'] == "user":
+    def summarizer_index(self):
+        """Index of the first user message after about 70% of the history tokens, everything before it is compressed."""
+        threshold = self.history_token_total * 0.7
+        tokens = 0
+        last_user_index = len(self.dialog_history)
+        for index, message_tokens in enumerate(self.history_tokens):
+            tokens += message_tokens
+            if self.dialog_history[index]['role'] == "user":
+                last_user_index = index
+                if tokens >= threshold:
                     return index
+        return last_user_index
 
-        return self.summarizer_index(text_len * 0.7)
 
+    def summarizer_needed(self, total_tokens, history_version):
+        # The usage reported for a request to an already compacted history is outdated, the estimate is used instead
+        if history_version != self.history_version:
+            total_tokens = 0
+        return max(total_tokens, self.estimate_prompt_tokens([])) >= self._chat_config.get('summarizer_limit')
+
+    def schedule_summarizer(self, chat_name, message=None):
+        """Compacts the dialog in the background, so the answer is sent without waiting for the summary."""
+        if self.summarizing:
+            return
+        logging.info(f"The token limit {self._chat_config.get('summarizer_limit')} for "
+                     f"the {chat_name} has been exceeded. Using a background summarizer")
+        self.summarizer_task = asyncio.create_task(self.run_summarizer(chat_name, message))
+
+    async def run_summarizer(self, chat_name, message=None):
+        try:
+            await self.summarizer(chat_name)
+        except ApiRequestException as e:
+            if message:
+                try:
+                    await message.reply(f"Ошибка суммарайзинга диалога: {e}.\nПросьба проверить логи бота!")
+                except Exception as e:
+                    logging.error(f"Failed to send the summarizer error message: {e}")
+            return
+        try:
+            await self.save_history()
+        except Exception as e:
+            logging.error("AITronic was unable to save the summarized conversation! Please check your database!")
+            logging.error(f"{e}\n{traceback.format_exc()}")
 
     async def summarizer(self, chat_name):
-        self.summarizer_used = True
+        """Rolling summary: only the previous summary and the messages added after it are sent to the LLM,
+        so the cost of compaction does not grow with the age of the dialog."""
+        history_version = self.history_version
         split = self.summarizer_index()
-        compressed_dialogue = self.dialog_history[:split:]
+        compressed_dialogue = [message.copy() for message in self.summary_messages() + self.dialog_history[:split:]]
         compressed_dialogue.append({"role": "user", "content": f'{self._chat_config.get("summariser_prompt")}'})
 
         # When sending pictures to the summarizer, it does not work correctly, so we delete them
         compressed_dialogue = self.cleaning_images(compressed_dialogue)
         try:
-            answer, total_tokens, _, _ = await self.send_api_request(compressed_dialogue)
+            answer, total_tokens, _, _, _ = await self.send_api_request(compressed_dialogue)
             if self.global_config.full_debug:
                 logging.debug(f"--FULL DEBUG INFO FOR DIALOG COMPRESSING--\n\n{compressed_dialogue}"
                               f"\n\n{answer}\n\n--END OF FULL DEBUG INFO FOR DIALOG COMPRESSING--")
@@ -453,7 +961,116 @@ class Dialog:
             raise e
 
         logging.info(f"Summarizing completed for {chat_name}, {total_tokens} tokens were used")
-        summarizer_data = [{"role": "user", "content": f'{self._chat_config.get("summariser_prompt")}'},
-                           {"role": "assistant", "content": answer}]
-        summarizer_data.extend(self.dialog_history[split::])
-        self.dialog_history = summarizer_data
+        if history_version != self.history_version:
+            logging.warning(f"The dialog in {chat_name} was replaced during summarizing, the summary is discarded")
+            return
+        # Messages added while the summary was being prepared are at the end of the history and are kept
+        self.set_summary(answer)
+        self.set_history(self.dialog_history[split::])
+
+
+class DialogCache:
+    """Bounded LRU cache of Dialog objects. Evicted dialogs are lazily loaded from the database again."""
+
+    def __init__(self, global_config, sql_helper: sql_worker.AsyncSqlWorker, client_pool: ClientPool,
+                 max_size, idle_ttl):
+        self.global_config = global_config
+        self.sql_helper = sql_helper
+        self.client_pool = client_pool
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.dialogs: OrderedDict[int, Dialog] = OrderedDict()
+        self.last_used: dict[int, float] = {}
+        self.loading: dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, chat_id) -> Dialog:
+        """Returns the dialog pinned for the calling task: it is not evicted until the task (the handler) is finished,
+        so a second copy of the dialog is never loaded from the DB while the first one is still in use."""
+        dialog = await self.load(chat_id)
+        task = asyncio.current_task()
+        if task and task not in dialog.holders:
+            dialog.holders.add(task)
+            task.add_done_callback(lambda _: self.unpin(dialog, task))
+        return dialog
+
+    def peek(self, chat_id) -> Optional[Dialog]:
+        """The cached dialog or None, without loading it and without counting a cache hit."""
+        return self.dialogs.get(chat_id) or self.sql_helper.dirty_dialogs.get(chat_id)
+
+    def unpin(self, dialog, task):
+        dialog.holders.discard(task)
+        self.evict_overflow()
+
+    async def load(self, chat_id) -> Dialog:
+        dialog = self.dialogs.get(chat_id)
+        if dialog:
+            self.hits += 1
+            self.dialogs.move_to_end(chat_id)
+            self.last_used[chat_id] = time.monotonic()
+            return dialog
+
+        self.misses += 1
+        # A dialog evicted in write-behind mode may not be saved yet, so it is taken back instead of the DB copy
+        dialog = self.sql_helper.dirty_dialogs.get(chat_id)
+        if not dialog:
+            task = self.loading.get(chat_id)
+            if not task:
+                task = asyncio.create_task(Dialog.create(chat_id, self.global_config,
+                                                         self.sql_helper, self.client_pool))
+                self.loading[chat_id] = task
+                task.add_done_callback(lambda _: self.loading.pop(chat_id, None))
+            dialog = await asyncio.shield(task)
+            if chat_id in self.dialogs:
+                return self.dialogs[chat_id]
+        elif not dialog.client:
+            dialog.make_client()
+
+        self.dialogs[chat_id] = dialog
+        self.last_used[chat_id] = time.monotonic()
+        self.evict_overflow()
+        return dialog
+
+    def evict(self, chat_id):
+        self.dialogs.pop(chat_id).close()
+        self.last_used.pop(chat_id)
+        self.evictions += 1
+
+    def evict_overflow(self):
+        # Dialogs that are used by handlers right now are kept
+        for chat_id in list(self.dialogs):
+            if len(self.dialogs) <= self.max_size:
+                break
+            if not self.dialogs[chat_id].busy:
+                self.evict(chat_id)
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_ttl
+        for chat_id in list(self.dialogs):
+            if self.last_used[chat_id] < deadline and not self.dialogs[chat_id].busy:
+                self.evict(chat_id)
+
+    async def auto_evict_idle(self):
+        while True:
+            await asyncio.sleep(60)
+            self.evict_idle()
+            logging.info(self.stats_text())
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': len(self.dialogs),
+            'max_size': self.max_size,
+            'messages': sum(len(dialog.dialog_history) for dialog in self.dialogs.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0,
+            'evictions': self.evictions
+        }
+
+    def stats_text(self):
+        stats = self.stats()
+        return (f"Dialog cache: {stats['size']}/{stats['max_size']} dialogs, {stats['messages']} messages in memory, "
+                f"hit rate {stats['hit_rate']:.1%}, {stats['evictions']} evictions")
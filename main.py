@@ -12,37 +12,46 @@ from aiogram import types, Bot, Dispatcher, exceptions
 from aiogram.filters.command import Command
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from pylatexenc.latex2text import LatexNodes2Text
 
 import ai_core
 import sql_worker
 import utils
 from utils import IncorrectConfig
 
-config = utils.ConfigData()
-bot = Bot(token=config.token)
 dp = Dispatcher()
-sql_helper = sql_worker.SqlWorker()
-inline_worker = utils.InlineWorker()
-latex_fixer = LatexNodes2Text()
 version = '1.3.10'
-
-dialogs = {}
 chats_queue = {}
 
+# LaTeX worker processes import this module under another name, they must not read the config,
+# open the database or create the bot again
+if __name__ == "__main__":
+    config = utils.ConfigData()
+    bot = Bot(token=config.token)
+    dispatcher = utils.OutboundDispatcher()
+    bot.session.middleware(dispatcher)
+    sql_helper = sql_worker.AsyncSqlWorker(config.write_behind_interval, config.write_behind_threshold)
+    inline_worker = utils.InlineWorker()
+    latex_converter = utils.LatexConverter(config.latex_workers, config.latex_timeout)
+    image_pipeline = utils.ImagePipeline(config.image_max_edge, config.image_quality,
+                                         config.image_cache_memory, config.image_cache_disk)
+
+    client_pool = ai_core.ClientPool(config.http_max_connections, config.http_max_keepalive,
+                                     config.http_keepalive_expiry)
+    dialogs = ai_core.DialogCache(config, sql_helper, client_pool, config.dialogs_cache_size,
+                                  config.dialogs_idle_ttl)
+
 @dp.message(Command("start"))
 async def start(message: types.Message):
     if not await utils.check_whitelist(message, config):
         return
 
-    if dialogs.get(message.chat.id) is None:
-        try:
-            dialogs.update({message.chat.id: ai_core.Dialog(message.chat.id, config, sql_helper)})
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            await message.reply(f"Ошибка в работе бота: {e}")
-            return
-    chat_config = dialogs.get(message.chat.id).chat_config
+    try:
+        dialog = await dialogs.get(message.chat.id)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        await message.reply(f"Ошибка в работе бота: {e}")
+        return
+    chat_config = dialog.chat_config
 
     answer = (f"Привет!\nЗдесь вы можете проверить ваши настройки, "
               f"чтобы начать работу с выбранной LLM:\n{utils.get_current_params(chat_config)}")
@@ -59,21 +68,19 @@ async def reset(message: types.Message):
     if not await utils.check_whitelist(message, config):
         return
 
-    if not dialogs.get(message.chat.id):
-        try:
-            dialogs.update({message.chat.id: ai_core.Dialog(message.chat.id, config, sql_helper)})
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            await message.reply(f"Ошибка в работе бота: {e}")
-            return
+    try:
+        dialog = await dialogs.get(message.chat.id)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        await message.reply(f"Ошибка в работе бота: {e}")
+        return
 
-    dialog = dialogs.get(message.chat.id)
     if not dialog.dialog_history:
         await message.reply(f"У вас нет диалога с ботом!")
         return
 
     try:
-        dialog.reset_dialog()
+        await dialog.reset_dialog()
         await message.reply(f"Контекст диалога успешно сброшен!")
     except Exception as e:
         logging.error(traceback.format_exc())
@@ -98,7 +105,8 @@ async def help_(message: types.Message):
               "но команды /confai edit и /confai done там не используются.\n"
               "Вы можете сохранять настройки чата как шаблон или загружать их из шаблона. "
               "Более подробная информация об этой возможности доступна с помощью команды /template.\n"
-              "Для сброса диалога введите команду /reset.")
+              "Для сброса диалога введите команду /reset.\n"
+              "Статистика работы бота доступна с помощью команды /stats.")
     await message.reply(answer)
 
 @dp.message(Command("confai"))
@@ -129,14 +137,13 @@ async def confai(message: types.Message):
         await message.reply("Данный чат не найден в вайтлисте бота. Бот здесь работать не будет.")
         return
 
-    if dialogs.get(msg_chat_id) is None:
-        try:
-            dialogs.update({msg_chat_id: ai_core.Dialog(msg_chat_id, config, sql_helper)})
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            await message.reply(f"Ошибка в работе бота: {e}")
-            return
-    chat_config = dialogs.get(msg_chat_id).chat_config
+    try:
+        dialog = await dialogs.get(msg_chat_id)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        await message.reply(f"Ошибка в работе бота: {e}")
+        return
+    chat_config = dialog.chat_config
 
     param_name = utils.extract_arg(message.text, 1)
     if private_messages and not config_mode:
@@ -247,8 +254,7 @@ async def confai(message: types.Message):
             reset_param_name = ""
 
         try:
-            dialogs.get(msg_chat_id).set_chat_config(sql_helper, chat_config,
-                                                     msg_chat_id, reset_param_name.replace('-', "_"))
+            await dialog.set_chat_config(sql_helper, chat_config, msg_chat_id, reset_param_name.replace('-', "_"))
             await message.reply(f'Настройки {reset_param_name}для {chat_name} успешно сброшены!{timer_text}')
         except Exception as e:
             logging.error(traceback.format_exc())
@@ -272,7 +278,7 @@ async def confai(message: types.Message):
         return
 
     try:
-        dialogs.get(msg_chat_id).set_chat_config(sql_helper, chat_config, msg_chat_id, param_name.replace("-", "_"))
+        await dialog.set_chat_config(sql_helper, chat_config, msg_chat_id, param_name.replace("-", "_"))
         await message.reply(f'Успешно обновлён параметр {param_name} для {chat_name}{timer_text}')
     except Exception as e:
         logging.error(traceback.format_exc())
@@ -286,18 +292,17 @@ async def template_(message: types.Message):
     if config.disable_confai or not await utils.check_whitelist(message, config):
         return
 
-    if dialogs.get(message.chat.id) is None:
-        try:
-            dialogs.update({message.chat.id: ai_core.Dialog(message.chat.id, config, sql_helper)})
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            await message.reply(f"Ошибка в работе бота: {e}")
-            return
+    try:
+        dialog = await dialogs.get(message.chat.id)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        await message.reply(f"Ошибка в работе бота: {e}")
+        return
 
-    chat_config = dialogs.get(message.chat.id).chat_config
+    chat_config = dialog.chat_config
 
     try:
-        current_templates = sql_helper.get_templates(message.chat.id)
+        current_templates = await sql_helper.get_templates(message.chat.id)
     except Exception as e:
         logging.error(traceback.format_exc())
         await message.reply(f"Ошибка в работе бота: {e}")
@@ -338,8 +343,8 @@ async def template_(message: types.Message):
             if template[1] == template_name:
                 if command == 'rewrite':
                     try:
-                        sql_helper.delete_template(message.chat.id, template_name)
-                        sql_helper.write_template(message.chat.id, template_name, chat_config)
+                        await sql_helper.delete_template(message.chat.id, template_name)
+                        await sql_helper.write_template(message.chat.id, template_name, chat_config)
                         await message.reply(f"Шаблон {template_name} успешно перезаписан.")
                     except Exception as e:
                         logging.error(traceback.format_exc())
@@ -351,7 +356,7 @@ async def template_(message: types.Message):
             await message.reply(f"Шаблон {template_name} не найден в списке шаблонов!")
             return
         try:
-            sql_helper.write_template(message.chat.id, template_name, chat_config)
+            await sql_helper.write_template(message.chat.id, template_name, chat_config)
             await message.reply(f"Шаблон {template_name} успешно добавлен.")
         except Exception as e:
             logging.error(traceback.format_exc())
@@ -387,6 +392,45 @@ async def version_(message: types.Message):
                             'Created by Allnorm aka DvadCat')
 
 
+@dp.message(Command("stats"))
+async def stats(message: types.Message):
+    if not await utils.check_whitelist(message, config):
+        return
+
+    try:
+        dialog = await dialogs.get(message.chat.id)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        await message.reply(f"Ошибка в работе бота: {e}")
+        return
+
+    cache_stats = dialogs.stats()
+    retry_stats = dialog.retry_stats
+    errors_text = ", ".join(f"{kind}: {count}" for kind, count in retry_stats['errors'].items()) or "нет"
+    image_stats = image_pipeline.stats()
+    lane_names = {'first': 'первые части', 'next': 'продолжения', 'edit': 'редактирования'}
+    outbound_text = "; ".join(f"{lane_names[name]} - в очереди {lane['queued']}, отправлено {lane['sent']}, "
+                              f"ожидание {lane['avg_wait']:.2f} с (макс. {lane['max_wait']:.2f} с)"
+                              for name, lane in dispatcher.stats().items() if name in lane_names)
+    await message.reply(f"Статистика AITronic:\n"
+                        f"* Диалогов в памяти: {cache_stats['size']} из {cache_stats['max_size']} "
+                        f"({cache_stats['messages']} сообщений)\n"
+                        f"* Попаданий в кэш диалогов: {cache_stats['hit_rate']:.1%} "
+                        f"({cache_stats['hits']} из {cache_stats['hits'] + cache_stats['misses']})\n"
+                        f"* Вытеснено диалогов из памяти: {cache_stats['evictions']}\n"
+                        f"* Исходящие запросы к Telegram: {outbound_text}\n"
+                        f"* Кэш картинок: попаданий в памяти {image_stats['memory_hits']}, "
+                        f"на диске {image_stats['disk_hits']}, промахов {image_stats['misses']} "
+                        f"({image_stats['hit_rate']:.1%}), {image_stats['memory_size'] / 1048576:.1f} МБ в памяти, "
+                        f"{image_stats['disk_size'] / 1048576:.1f} МБ на диске\n"
+                        f"* Пропущено статусов набора текста: {dispatcher.dropped_actions}, "
+                        f"ожиданий флуд-контроля: {dispatcher.flood_waits}\n\n"
+                        f"Статистика этого чата:\n"
+                        f"* Запросов к LLM: {retry_stats['requests']}, повторных попыток: {retry_stats['retries']}, "
+                        f"неудачных запросов: {retry_stats['failures']}\n"
+                        f"* Ошибки API: {errors_text}")
+
+
 @dp.callback_query(lambda call: call.data.startswith('t_load'))
 async def template_button(callback: types.CallbackQuery):
 
@@ -397,7 +441,7 @@ async def template_button(callback: types.CallbackQuery):
     message = callback.message
     try:
         template_name = callback.data.split('_', maxsplit=2)[2]
-        template = sql_helper.get_templates(callback.message.chat.id, template_name)
+        template = await sql_helper.get_templates(callback.message.chat.id, template_name)
         if not template:
             await message.edit_text(f"Шаблон {template_name} не найден в БД!")
             return
@@ -413,9 +457,8 @@ async def template_button(callback: types.CallbackQuery):
             await message.edit_text(f"Шаблон {template_name} имеет некорректные значения "
                                     f"в параметрах: {e} Требуется удалить или перезаписать шаблон.")
             return
-        if dialogs.get(message.chat.id) is None:
-            dialogs.update({message.chat.id: ai_core.Dialog(message.chat.id, config, sql_helper)})
-        dialogs.get(message.chat.id).set_chat_config(sql_helper, new_config, message.chat.id)
+        dialog = await dialogs.get(message.chat.id)
+        await dialog.set_chat_config(sql_helper, new_config, message.chat.id)
         await message.edit_text(f"Шаблон {template_name} успешно применён для данного чата.")
     except Exception as e:
         logging.error(traceback.format_exc())
@@ -433,11 +476,11 @@ async def template_button(callback: types.CallbackQuery):
     message = callback.message
     try:
         template_name = callback.data.split('_', maxsplit=2)[2]
-        template = sql_helper.get_templates(callback.message.chat.id, template_name)
+        template = await sql_helper.get_templates(callback.message.chat.id, template_name)
         if not template:
             await message.edit_text(f"Шаблон {template_name} не найден в БД!")
             return
-        sql_helper.delete_template(callback.message.chat.id, template_name)
+        await sql_helper.delete_template(callback.message.chat.id, template_name)
         await message.edit_text(f"Шаблон {template_name} успешно удалён.")
     except Exception as e:
         logging.error(traceback.format_exc())
@@ -476,15 +519,14 @@ async def confai_bool(callback: types.CallbackQuery):
             await bot.answer_callback_query(callback.id, "Вы не находитесь в режиме конфигурации чата!")
             return
 
-    if dialogs.get(msg_chat_id) is None:
-        try:
-            dialogs.update({msg_chat_id: ai_core.Dialog(msg_chat_id, config, sql_helper)})
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            await message.reply(f"Ошибка в работе бота: {e}")
-            return
+    try:
+        dialog = await dialogs.get(msg_chat_id)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        await message.reply(f"Ошибка в работе бота: {e}")
+        return
 
-    chat_config = dialogs.get(msg_chat_id).chat_config
+    chat_config = dialog.chat_config
 
     if not any([private_messages and button_chat_id == str(message.chat.id),
                 (await bot.get_chat_member(msg_chat_id, callback.from_user.id)).status
@@ -526,7 +568,7 @@ async def confai_bool(callback: types.CallbackQuery):
         button_param_value = not button_param_value
         chat_config.update({button_param_name: button_param_value})
         try:
-            dialogs.get(msg_chat_id).set_chat_config(sql_helper, chat_config, msg_chat_id, button_param_name)
+            await dialog.set_chat_config(sql_helper, chat_config, msg_chat_id, button_param_name)
             await bot.answer_callback_query(
                 callback.id, f'Значение параметра {button_param_name.replace("_", "-")} '
                              f'для {chat_name} установлено на {button_param_value}.', show_alert=True)
@@ -571,16 +613,15 @@ async def inline_button(callback: types.CallbackQuery):
     if callback.from_user.last_name:
         username += f' {callback.from_user.last_name}'
 
-    if dialogs.get(user_id) is None:
-        try:
-            dialogs.update({user_id: ai_core.Dialog(user_id, config, sql_helper)})
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            await utils.edit_inline_message(msg_txt, f"❗Ошибка в работе бота: {e}", inline_message_id,
-                                            config.full_debug, bot, None, 'markdown')
-            return
+    try:
+        dialog = await dialogs.get(user_id)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        await utils.edit_inline_message(msg_txt, f"❗Ошибка в работе бота: {e}", inline_message_id,
+                                        config.full_debug, bot, None, 'markdown')
+        return
 
-    chat_config = dialogs.get(user_id).chat_config
+    chat_config = dialog.chat_config
     broken_params = []
     for key, value in chat_config.items():
         if key in utils.MANDATORY_PARAMS and value is None:
@@ -599,7 +640,7 @@ async def inline_button(callback: types.CallbackQuery):
                                     config.full_debug, bot, None, parse_mode)
 
     try:
-        answer = await dialogs.get(user_id).get_answer_inline(username, msg_txt)
+        answer = await dialog.get_answer_inline(username, msg_txt)
     except ai_core.ApiRequestException as e:
         await utils.edit_inline_message(msg_txt, f'❌ Ошибка в работе бота: {e}', inline_message_id,
                                         config.full_debug, bot, None, parse_mode)
@@ -609,21 +650,31 @@ async def inline_button(callback: types.CallbackQuery):
                                     config.full_debug, bot, None, parse_mode, f'\n{answer}')
 
 
+def prefetch_images(message):
+    return [utils.prefetch_task(image_pipeline.get_image_from_message(msg, bot))
+            for msg in (message, message.reply_to_message) if image_pipeline.has_image(msg)]
+
+
 @dp.message(lambda message: utils.check_names(message, config))
 async def handler(message: types.Message):
 
     if not await utils.check_whitelist(message, config):
         return
 
-    if dialogs.get(message.chat.id) is None:
-        try:
-            dialogs.update({message.chat.id: ai_core.Dialog(message.chat.id, config, sql_helper)})
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            await message.reply(f"Ошибка в работе бота: {e}")
-            return
+    # The pictures are downloaded while the dialog is loaded. If the dialog is cached, the chat settings are
+    # already known and pictures are not downloaded without Vision.
+    cached_dialog = dialogs.peek(message.chat.id)
+    image_tasks = None
+    if cached_dialog is None or cached_dialog.chat_config.get('vision'):
+        image_tasks = prefetch_images(message)
+    try:
+        dialog = await dialogs.get(message.chat.id)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        await message.reply(f"Ошибка в работе бота: {e}")
+        return
 
-    chat_config = dialogs.get(message.chat.id).chat_config
+    chat_config = dialog.chat_config
     broken_params = []
     for key, value in chat_config.items():
         if key in utils.MANDATORY_PARAMS and value is None:
@@ -641,11 +692,14 @@ async def handler(message: types.Message):
     if message.quote and not chat_config.get('reply_to_quotes'):
         return
 
+    typing_task = utils.prefetch_task(bot.send_chat_action(chat_id=message.chat.id, action='typing'))
     photo_base64 = None
     try:
         if vision:
-            photo_base64 = (await utils.get_image_from_message(message, bot) or
-                            await utils.get_image_from_message(message.reply_to_message, bot))
+            for image_task in image_tasks if image_tasks is not None else prefetch_images(message):
+                photo_base64 = await image_task
+                if photo_base64:
+                    break
     except Exception as e:
         logging.error(traceback.format_exc())
         await message.reply(f"Ошибка в работе бота: {e}")
@@ -667,14 +721,23 @@ async def handler(message: types.Message):
     parse_mode = 'markdown' if chat_config.get('markdown_enable') else None
 
     try:
-        await bot.send_chat_action(chat_id=message.chat.id, action='typing')
+        await typing_task
     except exceptions.TelegramBadRequest as e:
         logging.error(f'Error sending message to chat {message.chat.id}\n{e}')
         return
 
+    turns = await dialog.coalesce(message, reply_msg, photo_base64)
+    if not turns:
+        return
+    # The answer to merged messages is addressed to the last of them
+    message = turns[-1][0]
+
+    streamer = utils.AnswerStreamer(message, bot, chat_config) if chat_config.get('stream_mode') else None
     try:
-        answer = await dialogs.get(message.chat.id).get_answer(message, reply_msg, photo_base64)
+        answer = await dialog.get_answer(turns, streamer.update if streamer else None)
     except ai_core.ApiRequestException as e:
+        if streamer:
+            await streamer.wait()
         await message.reply(f"Ошибка в работе бота: {e}")
         return
 
@@ -684,12 +747,8 @@ async def handler(message: types.Message):
         chats_queue.update({message.chat.id: asyncio.Lock()})
         chat_queue = chats_queue.get(message.chat.id)
 
-    locked = chat_queue.locked()
     async with chat_queue:
 
-        if locked:
-            await asyncio.sleep(3)
-
         if not answer.strip():
             await utils.send_message(message, bot, "Ошибка: LLM отправила пустой ответ",
                                      chat_config.get('markdown_filter'), parse_mode=parse_mode, reply=True)
@@ -697,23 +756,26 @@ async def handler(message: types.Message):
 
         answer = utils.answer_parser(answer, chat_config)
 
-        for index, paragraph in enumerate(answer):
+        if chat_config.get('latex_filter'):
+            answer = await asyncio.gather(*(latex_converter.convert(paragraph) for paragraph in answer))
 
-            if chat_config.get('latex_filter') and ('$' in paragraph or '\\' in paragraph):
-                answer[index] = latex_fixer.latex_to_text(paragraph)
+        # Sending is paced by utils.OutboundDispatcher, so the chunks go out as fast as the Telegram limits allow
+        delivery_start = time.monotonic()
 
-            if not index:
-                await utils.send_message(message, bot, answer[0], chat_config.get('markdown_filter'),
-                                         parse_mode=parse_mode, reply=True)
-                continue
-
-            try:
-                await bot.send_chat_action(chat_id=message.chat.id, action='typing')
-            except exceptions.TelegramBadRequest:
-                pass
+        # The streamed messages are already in the chat, only the final formatting is applied to them
+        if streamer:
+            await streamer.wait()
+            if streamer.sent_messages:
+                await streamer.finish(answer, parse_mode)
+                logging.info(f"Answer in chat {message.chat.id} delivered in {len(answer)} messages "
+                             f"in {time.monotonic() - delivery_start:.2f}s")
+                return
 
-            await asyncio.sleep(3)
-            await utils.send_message(message, bot, paragraph, chat_config.get('markdown_filter'), parse_mode=parse_mode)
+        for index, paragraph in enumerate(answer):
+            await utils.send_message(message, bot, paragraph, chat_config.get('markdown_filter'),
+                                     parse_mode=parse_mode, reply=not index)
+        logging.info(f"Answer in chat {message.chat.id} delivered in {len(answer)} messages "
+                     f"in {time.monotonic() - delivery_start:.2f}s")
 
 
 @dp.inline_query(lambda inline_query: inline_query.query != '')
@@ -763,7 +825,16 @@ async def main():
     config.my_username = f"@{get_me.username}"
     logging.info(f"###AITRONIC v{version} LAUNCHED SUCCESSFULLY###")
     asyncio.create_task(inline_worker.auto_remove_old())
-    await dp.start_polling(bot)
+    asyncio.create_task(dialogs.auto_evict_idle())
+    asyncio.create_task(sql_helper.auto_delete_unreferenced_images())
+    if sql_helper.write_behind:
+        asyncio.create_task(sql_helper.write_behind_loop())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await sql_helper.close()
+        await client_pool.close()
+        latex_converter.close()
 
 
 if __name__ == "__main__":
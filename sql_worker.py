@@ -1,22 +1,41 @@
+import asyncio
+import base64
+import binascii
+import hashlib
 import json
+import logging
 import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Pictures that are not referenced by any message are deleted after this time. The delay covers pictures
+# that are already stored while the message referring to them is still waiting for the write-behind flush.
+IMAGES_GRACE_PERIOD = 86400
 
 
 class SQLWrapper:
+    """Transaction over the shared connection. The lock serializes access from the event loop and executor threads."""
 
-    def __init__(self, dbname):
-        self.dbname = dbname
+    def __init__(self, connection: sqlite3.Connection, lock: threading.RLock):
+        self.sqlite_connection = connection
+        self.lock = lock
 
     def __enter__(self):
-        self.sqlite_connection = sqlite3.connect(self.dbname)
+        self.lock.acquire()
         self.cursor = self.sqlite_connection.cursor()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if not exc_type:
-            self.sqlite_connection.commit()
-        self.cursor.close()
-        self.sqlite_connection.close()
+        try:
+            if exc_type:
+                self.sqlite_connection.rollback()
+            else:
+                self.sqlite_connection.commit()
+            self.cursor.close()
+        finally:
+            self.lock.release()
 
 
 class SqlWorker:
@@ -24,22 +43,106 @@ class SqlWorker:
 
     def __init__(self):
 
-        sqlite_connection = sqlite3.connect(self.dbname)
-        cursor = sqlite_connection.cursor()
-        cursor.execute("""CREATE TABLE if not exists chats (
-                            chat_id TEXT NOT NULL PRIMARY KEY, 
-                            chat_config TEXT NOT NULL, 
-                            dialog_text TEXT);""")
-        cursor.execute("""CREATE TABLE if not exists templates (
-                            chat_id TEXT NOT NULL, 
-                            template_name TEXT NOT NULL, 
-                            template_data TEXT NOT NULL);""")
-        sqlite_connection.commit()
-        cursor.close()
-        sqlite_connection.close()
+        # One long-lived connection instead of a new one on every call. Statements are always passed as the same
+        # literal strings, so sqlite3 reuses the prepared statements from its cache.
+        self.sqlite_connection = sqlite3.connect(self.dbname, check_same_thread=False, cached_statements=128)
+        self.lock = threading.RLock()
+        with SQLWrapper(self.sqlite_connection, self.lock) as sql_wrapper:
+            sql_wrapper.cursor.execute("""PRAGMA journal_mode = WAL;""")
+            # In WAL mode NORMAL is still crash-safe for the database, only the last commits may be lost on power loss
+            sql_wrapper.cursor.execute("""PRAGMA synchronous = NORMAL;""")
+            sql_wrapper.cursor.execute("""CREATE TABLE if not exists chats (
+                                chat_id TEXT NOT NULL PRIMARY KEY,
+                                chat_config TEXT NOT NULL,
+                                dialog_text TEXT);""")
+            sql_wrapper.cursor.execute("""CREATE TABLE if not exists templates (
+                                chat_id TEXT NOT NULL,
+                                template_name TEXT NOT NULL,
+                                template_data TEXT NOT NULL);""")
+            sql_wrapper.cursor.execute("""CREATE TABLE if not exists messages (
+                                chat_id TEXT NOT NULL,
+                                seq INTEGER NOT NULL,
+                                role TEXT NOT NULL,
+                                content TEXT NOT NULL,
+                                PRIMARY KEY (chat_id, seq));""")
+            sql_wrapper.cursor.execute("""CREATE TABLE if not exists summaries (
+                                chat_id TEXT NOT NULL PRIMARY KEY,
+                                summary TEXT NOT NULL);""")
+            # Content-addressed store of pictures, dialogs keep only the hash
+            sql_wrapper.cursor.execute("""CREATE TABLE if not exists images (
+                                hash TEXT NOT NULL PRIMARY KEY,
+                                mime TEXT NOT NULL,
+                                data BLOB NOT NULL,
+                                saved INTEGER NOT NULL);""")
+        self.migrate_dialog_text()
+        self.migrate_inline_images()
+        self.delete_unreferenced_images()
+
+    def migrate_dialog_text(self):
+        """Moves dialogs saved by older versions as a single JSON list in chats.dialog_text to the messages table."""
+        with self.transaction() as sql_wrapper:
+            sql_wrapper.cursor.execute("""SELECT chat_id, dialog_text FROM chats WHERE dialog_text IS NOT NULL""")
+            for chat_id, dialog_text in sql_wrapper.cursor.fetchall():
+                try:
+                    dialog = json.loads(dialog_text)
+                except json.JSONDecodeError:
+                    logging.error(f"Unable to migrate the dialog of chat ID {chat_id}, it will be reset!")
+                    dialog = []
+                for message in dialog:
+                    message['content'] = self.store_inline_images(sql_wrapper, message['content'])
+                self.write_messages(sql_wrapper, chat_id, dialog)
+                sql_wrapper.cursor.execute("""UPDATE chats SET dialog_text = NULL WHERE chat_id = ?""", (chat_id,))
+
+    def migrate_inline_images(self):
+        """Moves pictures that older versions kept in the messages as data URLs to the images table."""
+        with self.transaction() as sql_wrapper:
+            sql_wrapper.cursor.execute("""SELECT chat_id, seq, role, content FROM messages
+                                          WHERE content LIKE '%"image_url"%'""")
+            for chat_id, seq, role, content in sql_wrapper.cursor.fetchall():
+                content = self.store_inline_images(sql_wrapper, json.loads(content))
+                self.write_messages(sql_wrapper, chat_id, [{"role": role, "content": content}], seq)
+
+    @staticmethod
+    def store_inline_images(sql_wrapper, content):
+        """Replaces {"type": "image_url"} parts with data URLs by references to the images table."""
+        if not isinstance(content, list):
+            return content
+        result = []
+        for part in content:
+            url = part.get('image_url', {}).get('url', '') if part.get('type') == 'image_url' else ''
+            header, _, encoded = url.partition(',')
+            if not header.startswith('data:') or not header.endswith(';base64'):
+                result.append(part)
+                continue
+            try:
+                data = base64.b64decode(encoded)
+            except (binascii.Error, ValueError):
+                logging.error("Unable to migrate a picture with a broken data URL, it will be removed!")
+                continue
+            image_hash = hashlib.sha256(data).hexdigest()
+            mime = header[5:-7]
+            sql_wrapper.cursor.execute("""INSERT INTO images VALUES (?,?,?,?)
+                                          ON CONFLICT(hash) DO UPDATE SET saved = excluded.saved;""",
+                                       (image_hash, mime, data, int(time.time())))
+            result.append({"type": "image", "image": {"hash": image_hash, "mime": mime}})
+        return result
+
+    @staticmethod
+    def write_messages(sql_wrapper, chat_id, messages, first_seq=0):
+        sql_wrapper.cursor.executemany("""INSERT OR REPLACE INTO messages VALUES (?,?,?,?);""",
+                                       [(chat_id, seq, message['role'],
+                                         json.dumps(message['content'], ensure_ascii=False))
+                                        for seq, message in enumerate(messages, first_seq)])
+
+    def close(self):
+        with self.lock:
+            self.sqlite_connection.close()
+
+    def transaction(self):
+        return SQLWrapper(self.sqlite_connection, self.lock)
 
     def get_dialog_data(self, chat_id, init_dict=None):
-        with SQLWrapper(self.dbname) as sql_wrapper:
+        with self.transaction() as sql_wrapper:
             sql_wrapper.cursor.execute("""SELECT * FROM chats WHERE chat_id = ?""", (chat_id,))
             record = sql_wrapper.cursor.fetchall()
             if not record and init_dict:
@@ -48,18 +151,73 @@ class SqlWorker:
                 return parameters
             return record[0]
 
+    def save_image(self, image_hash, mime, data):
+        with self.transaction() as sql_wrapper:
+            sql_wrapper.cursor.execute("""INSERT INTO images VALUES (?,?,?,?)
+                                          ON CONFLICT(hash) DO UPDATE SET saved = excluded.saved;""",
+                                       (image_hash, mime, data, int(time.time())))
+
+    def get_images(self, hashes):
+        hashes = list(hashes)
+        with self.transaction() as sql_wrapper:
+            sql_wrapper.cursor.execute(f"""SELECT hash, mime, data FROM images
+                                           WHERE hash IN ({",".join("?" * len(hashes))})""", hashes)
+            return {image_hash: (mime, data) for image_hash, mime, data in sql_wrapper.cursor.fetchall()}
+
+    def delete_unreferenced_images(self):
+        """Pictures are cleaned from dialogs after a few messages, after that no message refers to them."""
+        with self.transaction() as sql_wrapper:
+            sql_wrapper.cursor.execute("""SELECT content FROM messages WHERE content LIKE '%"hash"%'""")
+            referenced = set()
+            for content, in sql_wrapper.cursor.fetchall():
+                content = json.loads(content)
+                if isinstance(content, list):
+                    referenced.update(part['image']['hash'] for part in content if part.get('type') == 'image')
+            sql_wrapper.cursor.execute("""SELECT hash FROM images WHERE saved < ?""",
+                                       (int(time.time()) - IMAGES_GRACE_PERIOD,))
+            unreferenced = [(image_hash,) for image_hash, in sql_wrapper.cursor.fetchall()
+                            if image_hash not in referenced]
+            sql_wrapper.cursor.executemany("""DELETE FROM images WHERE hash = ?""", unreferenced)
+            return len(unreferenced)
+
     def dialog_conf_update(self, chat_config, chat_id):
-        with SQLWrapper(self.dbname) as sql_wrapper:
+        with self.transaction() as sql_wrapper:
             sql_wrapper.cursor.execute("""UPDATE chats SET chat_config = ? where chat_id = ?""",
                                        (json.dumps(chat_config, ensure_ascii=False), chat_id))
 
-    def dialog_update(self, dialog_text, chat_id):
-        with SQLWrapper(self.dbname) as sql_wrapper:
-            sql_wrapper.cursor.execute("""UPDATE chats SET dialog_text = ? where chat_id = ?""",
-                                       (json.dumps(dialog_text, ensure_ascii=False), chat_id))
+    def get_messages(self, chat_id):
+        with self.transaction() as sql_wrapper:
+            sql_wrapper.cursor.execute("""SELECT role, content FROM messages WHERE chat_id = ? ORDER BY seq""",
+                                       (chat_id,))
+            return [{"role": role, "content": json.loads(content)}
+                    for role, content in sql_wrapper.cursor.fetchall()]
+
+    def get_summary(self, chat_id):
+        with self.transaction() as sql_wrapper:
+            sql_wrapper.cursor.execute("""SELECT summary FROM summaries WHERE chat_id = ?""", (chat_id,))
+            record = sql_wrapper.cursor.fetchone()
+            return record[0] if record else None
+
+    def save_dialogs(self, changes):
+        """Saves changes of one or several dialogs in a single transaction.
+        Each change is (chat_id, messages, first_seq, rewrite, summary, updated): the rewrite flag replaces the whole
+        dialog, summary is None if it has not changed and an empty string if it was removed,
+        updated is a list of (seq, message) of already saved messages that were changed."""
+        with self.transaction() as sql_wrapper:
+            for chat_id, messages, first_seq, rewrite, summary, updated in changes:
+                if rewrite:
+                    sql_wrapper.cursor.execute("""DELETE FROM messages WHERE chat_id = ?""", (chat_id,))
+                self.write_messages(sql_wrapper, chat_id, messages, first_seq)
+                for seq, message in updated:
+                    self.write_messages(sql_wrapper, chat_id, [message], seq)
+                if summary:
+                    sql_wrapper.cursor.execute("""INSERT OR REPLACE INTO summaries VALUES (?,?);""",
+                                               (chat_id, summary))
+                elif summary is not None:
+                    sql_wrapper.cursor.execute("""DELETE FROM summaries WHERE chat_id = ?""", (chat_id,))
 
     def get_templates(self, chat_id, template_name=None):
-        with SQLWrapper(self.dbname) as sql_wrapper:
+        with self.transaction() as sql_wrapper:
             if template_name:
                 sql_wrapper.cursor.execute("""SELECT * FROM templates WHERE chat_id = ? AND template_name = ?""",
                                            (chat_id, template_name))
@@ -68,12 +226,112 @@ class SqlWorker:
             return sql_wrapper.cursor.fetchall()
 
     def write_template(self, chat_id, template_name, template_data):
-        with SQLWrapper(self.dbname) as sql_wrapper:
+        with self.transaction() as sql_wrapper:
             sql_wrapper.cursor.execute("""INSERT INTO templates VALUES (?,?,?);""",
                                        (chat_id, template_name,
                                         json.dumps(template_data, ensure_ascii=False)))
 
     def delete_template(self, chat_id, template_name):
-        with SQLWrapper(self.dbname) as sql_wrapper:
+        with self.transaction() as sql_wrapper:
             sql_wrapper.cursor.execute("""DELETE FROM templates WHERE chat_id = ? AND template_name = ?""",
-                                       (chat_id, template_name))
\ No newline at end of file
+                                       (chat_id, template_name))
+
+
+class AsyncSqlWorker:
+    """SqlWorker for the event loop: every query is executed in a dedicated database thread,
+    so a slow commit does not block polling and answers in other chats."""
+
+    def __init__(self, write_behind_interval=0, write_behind_threshold=0):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sql_worker")
+        self.sql_worker = SqlWorker()
+        # Write-behind mode: changed dialogs are collected and saved in one transaction
+        # every write_behind_interval seconds or as soon as write_behind_threshold dialogs are dirty
+        self.write_behind_interval = write_behind_interval
+        self.write_behind_threshold = write_behind_threshold
+        self.dirty_dialogs = {}
+        self.flush_event = asyncio.Event()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            await self.run(self.sql_worker.close)
+            self.executor.shutdown(wait=True)
+
+    @property
+    def write_behind(self):
+        return self.write_behind_interval > 0
+
+    def mark_dirty(self, dialog):
+        self.dirty_dialogs[dialog.chat_id] = dialog
+        if self.write_behind_threshold and len(self.dirty_dialogs) >= self.write_behind_threshold:
+            self.flush_event.set()
+
+    async def write_behind_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), self.write_behind_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Write-behind flush failed, the dialogs will be saved on the next attempt!\n{e}")
+                logging.error(traceback.format_exc())
+
+    async def flush(self):
+        if not self.dirty_dialogs:
+            return
+        dialogs, self.dirty_dialogs = self.dirty_dialogs, {}
+        changes = [change for change in (dialog.collect_changes() for dialog in dialogs.values()) if change]
+        try:
+            await self.save_dialogs(changes)
+        except Exception:
+            for chat_id, dialog in dialogs.items():
+                dialog.mark_unsaved()
+                self.dirty_dialogs.setdefault(chat_id, dialog)
+            raise
+
+    async def get_dialog_data(self, chat_id, init_dict=None):
+        return await self.run(self.sql_worker.get_dialog_data, chat_id, init_dict)
+
+    async def save_image(self, image_hash, mime, data):
+        return await self.run(self.sql_worker.save_image, image_hash, mime, data)
+
+    async def get_images(self, hashes):
+        return await self.run(self.sql_worker.get_images, hashes)
+
+    async def auto_delete_unreferenced_images(self):
+        while True:
+            await asyncio.sleep(3600)
+            try:
+                deleted = await self.run(self.sql_worker.delete_unreferenced_images)
+                if deleted:
+                    logging.info(f"Deleted {deleted} pictures that are no longer used in dialogs")
+            except Exception as e:
+                logging.error(f"Error deleting unused pictures!\n{e}\n{traceback.format_exc()}")
+
+    async def dialog_conf_update(self, chat_config, chat_id):
+        return await self.run(self.sql_worker.dialog_conf_update, chat_config, chat_id)
+
+    async def get_messages(self, chat_id):
+        return await self.run(self.sql_worker.get_messages, chat_id)
+
+    async def get_summary(self, chat_id):
+        return await self.run(self.sql_worker.get_summary, chat_id)
+
+    async def save_dialogs(self, changes):
+        return await self.run(self.sql_worker.save_dialogs, changes)
+
+    async def get_templates(self, chat_id, template_name=None):
+        return await self.run(self.sql_worker.get_templates, chat_id, template_name)
+
+    async def write_template(self, chat_id, template_name, template_data):
+        return await self.run(self.sql_worker.write_template, chat_id, template_name, template_data)
+
+    async def delete_template(self, chat_id, template_name):
+        return await self.run(self.sql_worker.delete_template, chat_id, template_name)
@@ -0,0 +1,101 @@
+import math
+import re
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Pre-tokenization in the style of GPT BPE tokenizers: words with a leading space, short digit groups,
+# punctuation runs and whitespace are merged into tokens separately from each other
+PRETOKENIZE_PATTERN = re.compile(r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+(?!\S)|\s+")
+
+
+class TokenEstimator:
+    """Offline estimate of the number of tokens, close to what BPE tokenizers of the LLM vendors return.
+    Words of the Latin alphabet are merged into longer tokens than Cyrillic and other alphabets."""
+
+    latin_chars_per_token = 4.2
+    other_chars_per_token = 2.6
+    punctuation_chars_per_token = 1.6
+    message_overhead = 4
+    image_tokens = 765
+
+    def count_text(self, text: str) -> int:
+        tokens = 0
+        for piece in PRETOKENIZE_PATTERN.findall(text):
+            word = piece.lstrip(' ')
+            if not word or word.isspace():
+                tokens += 1
+            elif word.isascii() and word.isalpha():
+                tokens += max(1, round(len(word) / self.latin_chars_per_token))
+            elif word.isalpha():
+                tokens += max(1, round(len(word) / self.other_chars_per_token))
+            elif word.isdigit():
+                tokens += 1
+            else:
+                tokens += math.ceil(len(word) / self.punctuation_chars_per_token)
+        return tokens
+
+    def count_message(self, message: dict) -> int:
+        content = message['content']
+        if not isinstance(content, list):
+            return self.message_overhead + self.count_text(content)
+        tokens = self.message_overhead
+        for part in content:
+            if part['type'] == 'text':
+                tokens += self.count_text(part['text'])
+            else:
+                tokens += self.image_tokens
+        return tokens
+
+
+class AnthropicEstimator(TokenEstimator):
+    latin_chars_per_token = 3.8
+    other_chars_per_token = 2.2
+    # A picture of about 1092x1092 pixels, (width * height) / 750 tokens according to the Anthropic documentation
+    image_tokens = 1600
+
+
+class TiktokenEstimator(TokenEstimator):
+    """Exact count for OpenAI models if the optional tiktoken package is installed."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+    def count_text(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+def load_encoding(model):
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+        tiktoken_estimators[model] = TiktokenEstimator(encoding)
+    except Exception:
+        # tiktoken downloads encodings on first use, without network the estimate is used
+        tiktoken_estimators[model] = None
+
+
+offline_estimator = TokenEstimator()
+anthropic_estimator = AnthropicEstimator()
+# Estimators for OpenAI models by model name, None if the encoding could not be loaded
+tiktoken_estimators = {}
+loading_models = set()
+
+
+def get_estimator(vendor, model) -> TokenEstimator:
+    if vendor == 'anthropic':
+        return anthropic_estimator
+    if not tiktoken:
+        return offline_estimator
+    if model in tiktoken_estimators:
+        return tiktoken_estimators[model] or offline_estimator
+    # Loading an encoding may download it, so it is loaded in a thread and the estimate is used until it is ready
+    if model not in loading_models:
+        loading_models.add(model)
+        threading.Thread(target=load_encoding, args=(model,), name="tiktoken_loader", daemon=True).start()
+    return offline_estimator
@@ -2,16 +2,31 @@ import asyncio
 import configparser
 import json
 import logging
+import multiprocessing
 import os
 import sys
 import time
 import traceback
 import base64
-from dataclasses import dataclass
+import bisect
+import hashlib
+import io
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from importlib import reload
 from typing import Optional
 
 from aiogram import types, exceptions
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import SendChatAction
+from pylatexenc.latex2text import LatexNodes2Text
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 CHAT_CONFIG_TEMPLATE = {
     'api_key': None,
@@ -21,6 +36,7 @@ CHAT_CONFIG_TEMPLATE = {
     'base_url': None,
     'vision': False,
     'stream_mode': False,
+    'prompt_caching': False,
     'temperature': 0.5,
     'attempts': 7,
     'threads_limit': 10,
@@ -34,16 +50,24 @@ CHAT_CONFIG_TEMPLATE = {
     'tokens_per_answer': 2000,
     'max_chunk_size': 3000,
     'summarizer_limit': 12000,
+    'context_limit': 0,
+    'images_window': 10,
+    'coalesce_window': 0,
     'summariser_prompt': 'Create a short summary of the text previously discussed with the user.',
     'prefill_prompt': None,
     'prefill_mode': 'assistant'
 }
 
+SENTENCE_ENDS = (". ", "! ", "? ")
+FENCE_PATTERN = re.compile(r"^```[^\n]*", re.MULTILINE)
+FENCE_CLOSING = "\n```"
+
 MANDATORY_PARAMS = ('api_key', 'model')
 PRIVATE_PARAMS = ('api_key', 'system_prompt', 'base_url', 'prefill_prompt')
 BOOL_PARAMS = ('vision', 'stream_mode', 'markdown_enable', 'markdown_filter', 'allow_config_everyone',
-               'split_paragraphs', 'reply_to_quotes', 'show_used_tokens', 'latex_filter')
-INT_PARAMS = ('attempts', 'threads_limit', 'tokens_per_answer', 'max_chunk_size', 'summarizer_limit')
+               'split_paragraphs', 'reply_to_quotes', 'show_used_tokens', 'latex_filter', 'prompt_caching')
+INT_PARAMS = ('attempts', 'threads_limit', 'tokens_per_answer', 'max_chunk_size', 'summarizer_limit',
+              'context_limit', 'images_window', 'coalesce_window')
 
 
 class IncorrectConfig(Exception):
@@ -86,6 +110,21 @@ class ConfigData:
                 self.tag_phrase = config["Bot"]["tag-phrase"]
                 self.full_debug = self.bool_init(config["Bot"]["full-debug"])
                 self.disable_confai = self.bool_init(config["Bot"]["disable-confai"])
+                # Optional settings, older config files may not contain them
+                self.write_behind_interval = float(config["Bot"].get("write-behind-interval", "0"))
+                self.write_behind_threshold = int(config["Bot"].get("write-behind-threshold", "50"))
+                self.dialogs_cache_size = int(config["Bot"].get("dialogs-cache-size", "1000"))
+                self.dialogs_idle_ttl = int(config["Bot"].get("dialogs-idle-ttl", "86400"))
+                self.http_max_connections = int(config["Bot"].get("http-max-connections", "100"))
+                self.http_max_keepalive = int(config["Bot"].get("http-max-keepalive", "20"))
+                self.http_keepalive_expiry = float(config["Bot"].get("http-keepalive-expiry", "30"))
+                self.latex_workers = int(config["Bot"].get("latex-workers", "2"))
+                self.latex_timeout = float(config["Bot"].get("latex-timeout", "10"))
+                self.image_max_edge = int(config["Bot"].get("image-max-edge", "1568"))
+                self.image_quality = int(config["Bot"].get("image-quality", "85"))
+                # Sizes of the picture caches in megabytes, 0 disables the disk cache
+                self.image_cache_memory = int(config["Bot"].get("image-cache-memory", "32")) * 1024 * 1024
+                self.image_cache_disk = int(config["Bot"].get("image-cache-disk", "256")) * 1024 * 1024
                 if self.bool_init(config["Bot"]["use-json-template"]):
                     self.json_template_init()
                 break
@@ -117,6 +156,19 @@ class ConfigData:
         config.set("Bot", "full-debug", "false")
         config.set("Bot", "use-json-template", "true")
         config.set("Bot", "disable-confai", "false")
+        config.set("Bot", "write-behind-interval", "0")
+        config.set("Bot", "write-behind-threshold", "50")
+        config.set("Bot", "dialogs-cache-size", "1000")
+        config.set("Bot", "dialogs-idle-ttl", "86400")
+        config.set("Bot", "http-max-connections", "100")
+        config.set("Bot", "http-max-keepalive", "20")
+        config.set("Bot", "http-keepalive-expiry", "30")
+        config.set("Bot", "latex-workers", "2")
+        config.set("Bot", "latex-timeout", "10")
+        config.set("Bot", "image-max-edge", "1568")
+        config.set("Bot", "image-quality", "85")
+        config.set("Bot", "image-cache-memory", "32")
+        config.set("Bot", "image-cache-disk", "256")
         try:
             config.write(open("config.ini", "w"))
             print("New config file was created successful")
@@ -183,6 +235,237 @@ class InlineWorker:
             return self.__inlines_dict.get(unique_id)[1]
         return None
 
+latex_fixer: Optional[LatexNodes2Text] = None
+
+
+def latex_to_text(text):
+    # Runs in a worker process, the converter is created once per process
+    global latex_fixer
+    if latex_fixer is None:
+        latex_fixer = LatexNodes2Text()
+    return latex_fixer.latex_to_text(text)
+
+
+class LatexConverter:
+    """Converts LaTeX in answers to text in worker processes, so parsing a long formula does not block the bot.
+    Results are cached, if the conversion takes longer than the timeout, the original text is sent."""
+
+    def __init__(self, workers, timeout, cache_size=1024):
+        # The start method is the same on every platform, so the workers never inherit the threads
+        # and sockets of the bot by fork
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    async def convert(self, text):
+        if '$' not in text and '\\' not in text:
+            return text
+        key = hashlib.sha1(text.encode('utf-8')).digest()
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        try:
+            result = await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(self.executor, latex_to_text, text), self.timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"LaTeX conversion took longer than {self.timeout} seconds, the text is sent as is")
+            return text
+        except Exception as e:
+            logging.error(f"LaTeX conversion failed, the text is sent as is\n{e}")
+            return text
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TokenBucket:
+    """Rate limit with a burst."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now) -> float:
+        """How long to wait until a token is available."""
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds, now):
+        self.refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass(order=True)
+class OutboundRequest:
+    lane: int
+    seq: int
+    chat_id: Optional[int] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    queued: float = field(compare=False)
+
+
+class OutboundDispatcher(BaseRequestMiddleware):
+    """Bot session middleware through which all Telegram API calls go. Sending and editing messages is limited
+    by token buckets according to the Telegram limits: about one message per second in a private chat,
+    20 messages per minute in a group and 30 messages per second in total. Waiting requests are released
+    by priority lanes, so the first chunk of an answer is not stuck behind continuations and stream edits
+    of other answers. Chat actions are dropped when the queue is not empty.
+    TelegramRetryAfter postpones the chat for the time requested by Telegram before the request is repeated."""
+
+    LANE_FIRST, LANE_NEXT, LANE_EDIT, LANE_ACTION = range(4)
+    lane_names = ('first', 'next', 'edit', 'action')
+
+    private_rate, private_burst = 1, 3
+    group_rate, group_burst = 20 / 60, 5
+    global_rate, global_burst = 30, 30
+    max_retries = 3
+    max_idle_buckets = 10000
+    paced_methods = ('Send', 'Copy', 'Forward', 'Edit', 'DeleteMessage')
+
+    def __init__(self):
+        self.buckets = {}
+        self.global_bucket = TokenBucket(self.global_rate, self.global_burst)
+        self.pending = []
+        self.seq = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.sent = [0] * len(self.lane_names)
+        self.wait_total = [0.0] * len(self.lane_names)
+        self.wait_max = [0.0] * len(self.lane_names)
+        self.dropped_actions = 0
+        self.flood_waits = 0
+
+    def get_bucket(self, chat_id, now):
+        bucket = self.buckets.get(chat_id)
+        if bucket:
+            return bucket
+        if len(self.buckets) >= self.max_idle_buckets:
+            self.buckets = {key: value for key, value in self.buckets.items() if not value.idle(now)}
+        # Group and channel IDs are negative
+        if str(chat_id).startswith('-'):
+            bucket = TokenBucket(self.group_rate, self.group_burst)
+        else:
+            bucket = TokenBucket(self.private_rate, self.private_burst)
+        self.buckets[chat_id] = bucket
+        return bucket
+
+    def get_lane(self, method):
+        if isinstance(method, SendChatAction):
+            return self.LANE_ACTION
+        if type(method).__name__.startswith('Edit'):
+            return self.LANE_EDIT
+        if getattr(method, 'reply_parameters', None) or getattr(method, 'reply_to_message_id', None):
+            return self.LANE_FIRST
+        return self.LANE_NEXT
+
+    def dispatch(self):
+        """Releases waiting requests in the order of lanes while the buckets have tokens,
+        and sets a timer for the moment when the next one can be released."""
+        self.timer = None
+        now = time.monotonic()
+        next_time = None
+        for request in sorted(self.pending):
+            global_wait = self.global_bucket.wait_time(now)
+            if global_wait:
+                next_time = global_wait
+                break
+            chat_wait = self.get_bucket(request.chat_id, now).wait_time(now) if request.chat_id is not None else 0
+            if chat_wait:
+                next_time = chat_wait if next_time is None else min(next_time, chat_wait)
+                continue
+            self.global_bucket.take(now)
+            if request.chat_id is not None:
+                self.get_bucket(request.chat_id, now).take(now)
+            self.pending.remove(request)
+            if not request.future.done():
+                request.future.set_result(None)
+        if self.pending and next_time is not None:
+            self.timer = asyncio.get_running_loop().call_later(next_time, self.dispatch)
+
+    async def acquire(self, lane, chat_id):
+        self.seq += 1
+        request = OutboundRequest(lane, self.seq, chat_id, asyncio.get_running_loop().create_future(),
+                                  time.monotonic())
+        self.pending.append(request)
+        if self.timer:
+            self.timer.cancel()
+        self.dispatch()
+        try:
+            await request.future
+        finally:
+            if request in self.pending:
+                self.pending.remove(request)
+        waited = time.monotonic() - request.queued
+        self.sent[lane] += 1
+        self.wait_total[lane] += waited
+        self.wait_max[lane] = max(self.wait_max[lane], waited)
+
+    async def __call__(self, make_request, bot, method):
+        # Only sending, editing and deleting messages counts against the limits, polling,
+        # file downloads, chat lookups and answers to queries go through as is
+        if not type(method).__name__.startswith(self.paced_methods):
+            return await make_request(bot, method)
+        lane = self.get_lane(method)
+        chat_id = getattr(method, 'chat_id', None)
+        if lane == self.LANE_ACTION:
+            # "Typing" is only a hint, it is not worth delaying messages for it
+            if self.pending or self.global_bucket.wait_time(time.monotonic()):
+                self.dropped_actions += 1
+                return True
+            self.global_bucket.take(time.monotonic())
+            return await make_request(bot, method)
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(lane, chat_id)
+            try:
+                return await make_request(bot, method)
+            except exceptions.TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.flood_waits += 1
+                logging.warning(f"Flood control in chat {chat_id}, the request will be repeated "
+                                f"in {e.retry_after} seconds")
+                now = time.monotonic()
+                if chat_id is not None:
+                    self.get_bucket(chat_id, now).block(e.retry_after, now)
+                else:
+                    self.global_bucket.block(e.retry_after, now)
+        return None
+
+    def stats(self):
+        queued = [0] * len(self.lane_names)
+        for request in self.pending:
+            queued[request.lane] += 1
+        return {name: {'queued': queued[lane], 'sent': self.sent[lane],
+                       'avg_wait': self.wait_total[lane] / self.sent[lane] if self.sent[lane] else 0.0,
+                       'max_wait': self.wait_max[lane]}
+                for lane, name in enumerate(self.lane_names)}
+
+    def stats_text(self):
+        lanes = ", ".join(f"{name}: {lane['queued']} queued, {lane['sent']} sent, "
+                          f"wait avg {lane['avg_wait']:.2f}s max {lane['max_wait']:.2f}s"
+                          for name, lane in self.stats().items() if name != 'action')
+        return (f"Outbound dispatcher: {lanes}; {self.dropped_actions} chat actions dropped, "
+                f"{self.flood_waits} flood waits")
+
+
 def username_parser(message, html=False):
     if message.from_user.first_name == "":
         return "DELETED USER"
@@ -284,6 +567,13 @@ def config_validator(name, value) -> dict:
         raise IncorrectConfig(f'"{name_replace}" имеет недопустимое значение (допускается от 50 до 4096).')
     if name == 'summarizer_limit' and value < 1000:
         raise IncorrectConfig(f'"{name_replace}" имеет недопустимое значение (допускается от 1000).')
+    if name == 'context_limit' and 0 < value < 1000:
+        raise IncorrectConfig(f'"{name_replace}" имеет недопустимое значение '
+                              f'(допускается 0 для отключения или от 1000).')
+    if name == 'images_window' and value < 0:
+        raise IncorrectConfig(f'"{name_replace}" имеет недопустимое значение (допускается от 0).')
+    if name == 'coalesce_window' and not 0 <= value <= 30:
+        raise IncorrectConfig(f'"{name_replace}" имеет недопустимое значение (допускается от 0 до 30).')
     return {name: value}
 
 
@@ -310,19 +600,174 @@ def check_names(message, config):
     return False
 
 
-async def get_image_from_message(message, bot) -> Optional[dict]:
-    if not message:
-        return None
-    elif message.photo:
-        byte_file = await bot.download(message.photo[-1].file_id)
-        mime = "image/jpeg"
-    elif message.sticker:
-        byte_file = await bot.download(message.sticker.thumbnail.file_id)
-        mime = "image/webp"
-    else:
-        return None
-    # noinspection PyUnresolvedReferences
-    return {"data": base64.b64encode(byte_file.getvalue()).decode('utf-8'), "mime": mime}
+class ImagePipeline:
+    """Prepares pictures from messages for the LLM: takes the smallest Telegram photo size that is not smaller than
+    max_edge, downscales and recompresses it to JPEG with Pillow. Without Pillow the largest size that fits
+    into max_edge is taken instead.
+    Processing runs in a thread. Prepared pictures are cached by file_unique_id in memory and on disk,
+    both caches are limited by size and evict the least recently used pictures."""
+
+    cache_dir = "image_cache"
+    extensions = {"image/jpeg": ".jpg", "image/webp": ".webp"}
+
+    def __init__(self, max_edge, quality, memory_limit, disk_limit):
+        self.max_edge = max_edge
+        self.quality = quality
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory_cache = OrderedDict()
+        self.memory_size = 0
+        self.disk_index = OrderedDict()
+        self.disk_size = 0
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+        if disk_limit:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.load_disk_index()
+
+    def load_disk_index(self):
+        entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.is_file()),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            self.disk_index[entry.name] = entry.stat().st_size
+            self.disk_size += entry.stat().st_size
+        for name in self.evict_disk():
+            self.remove_file(name)
+
+    def evict_disk(self) -> list:
+        evicted = []
+        while self.disk_size > self.disk_limit and self.disk_index:
+            name, size = self.disk_index.popitem(last=False)
+            self.disk_size -= size
+            evicted.append(name)
+        return evicted
+
+    def remove_file(self, name):
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except OSError as e:
+            logging.error(f"Unable to remove {name} from the picture cache\n{e}")
+
+    def read_file(self, name) -> dict:
+        path = os.path.join(self.cache_dir, name)
+        with open(path, "rb") as file:
+            data = file.read()
+        # The modification time keeps the order of use after a restart
+        os.utime(path)
+        mime = next(mime for mime, extension in self.extensions.items() if name.endswith(extension))
+        return {"data": base64.b64encode(data).decode('utf-8'), "mime": mime}
+
+    def write_file(self, name, data, evicted):
+        path = os.path.join(self.cache_dir, name)
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(data)
+        os.replace(f"{path}.tmp", path)
+        for evicted_name in evicted:
+            self.remove_file(evicted_name)
+
+    def remember(self, key, image):
+        self.memory_cache[key] = image
+        self.memory_size += len(image['data'])
+        while self.memory_size > self.memory_limit and self.memory_cache:
+            _, evicted = self.memory_cache.popitem(last=False)
+            self.memory_size -= len(evicted['data'])
+
+    def pick_photo_size(self, photos):
+        # Telegram lists the sizes of a photo from the smallest to the largest
+        if not self.max_edge:
+            return photos[-1]
+        if not Image:
+            # Without Pillow the picture is sent as is, so it must already fit into max_edge
+            fitting = [photo for photo in photos if max(photo.width, photo.height) <= self.max_edge]
+            return fitting[-1] if fitting else photos[0]
+        for photo in photos:
+            if max(photo.width, photo.height) >= self.max_edge:
+                return photo
+        return photos[-1]
+
+    def process(self, data, mime) -> bytes:
+        if Image and self.max_edge and mime == "image/jpeg":
+            try:
+                with Image.open(io.BytesIO(data)) as image:
+                    if max(image.size) > self.max_edge:
+                        image.thumbnail((self.max_edge, self.max_edge), Image.Resampling.LANCZOS)
+                        output = io.BytesIO()
+                        image.convert("RGB").save(output, "JPEG", quality=self.quality, optimize=True)
+                        data = output.getvalue()
+            except Exception as e:
+                logging.error(f"Unable to downscale the picture, it will be sent as is\n{e}")
+        return data
+
+    @staticmethod
+    def has_image(message):
+        return bool(message and (message.photo or (message.sticker and message.sticker.thumbnail)))
+
+    async def get_image_from_message(self, message, bot) -> Optional[dict]:
+        if not message:
+            return None
+        elif message.photo:
+            file = self.pick_photo_size(message.photo)
+            mime = "image/jpeg"
+        elif message.sticker and message.sticker.thumbnail:
+            file = message.sticker.thumbnail
+            mime = "image/webp"
+        else:
+            return None
+
+        key = file.file_unique_id
+        if key in self.memory_cache:
+            self.hits['memory'] += 1
+            self.memory_cache.move_to_end(key)
+            return self.memory_cache[key]
+
+        name = f"{key}{self.extensions[mime]}"
+        if name in self.disk_index:
+            try:
+                image = await asyncio.to_thread(self.read_file, name)
+            except OSError as e:
+                # Another request may have evicted the file while it was read
+                if name in self.disk_index:
+                    logging.error(f"Unable to read {name} from the picture cache\n{e}")
+                    self.disk_size -= self.disk_index.pop(name)
+            else:
+                self.hits['disk'] += 1
+                if name in self.disk_index:
+                    self.disk_index.move_to_end(name)
+                self.remember(key, image)
+                return image
+
+        self.misses += 1
+        byte_file = await bot.download(file.file_id)
+        # noinspection PyUnresolvedReferences
+        data = await asyncio.to_thread(self.process, byte_file.getvalue(), mime)
+        image = {"data": base64.b64encode(data).decode('utf-8'), "mime": mime}
+        self.remember(key, image)
+
+        if self.disk_limit and name not in self.disk_index:
+            self.disk_index[name] = len(data)
+            self.disk_size += len(data)
+            try:
+                await asyncio.to_thread(self.write_file, name, data, self.evict_disk())
+            except OSError as e:
+                logging.error(f"Unable to save {name} to the picture cache\n{e}")
+                if name in self.disk_index:
+                    self.disk_size -= self.disk_index.pop(name)
+        return image
+
+    def stats(self):
+        requests = self.hits['memory'] + self.hits['disk'] + self.misses
+        return {'memory_hits': self.hits['memory'], 'disk_hits': self.hits['disk'], 'misses': self.misses,
+                'hit_rate': (requests - self.misses) / requests if requests else 0.0,
+                'memory_size': self.memory_size, 'memory_items': len(self.memory_cache),
+                'disk_size': self.disk_size, 'disk_items': len(self.disk_index)}
+
+
+def prefetch_task(coro) -> asyncio.Task:
+    """Starts a request whose result may turn out to be unnecessary. The error of a task that was not awaited
+    is not reported, the error of an awaited one is raised as usual."""
+    task = asyncio.create_task(coro)
+    task.add_done_callback(lambda done_task: done_task.cancelled() or done_task.exception())
+    return task
 
 
 def get_poll_text(message):
@@ -334,47 +779,78 @@ def get_poll_text(message):
     return poll_text
 
 
-def message_len_parser(text, config, fn_list):
-    max_len = config.get('max_chunk_size')
-
-    while len(text) > max_len:
-
-        parsed = False
+def code_fences(text):
+    """Ranges of Markdown code blocks as (start, end, opening line). A block left unclosed by the LLM lasts
+    to the end of the text."""
+    fences = []
+    matches = FENCE_PATTERN.finditer(text)
+    for opening in matches:
+        closing = next(matches, None)
+        fences.append((opening.start(), closing.end() if closing else len(text), opening.group()))
+    return fences
+
+
+def message_len_parser(text, max_len):
+    """Splits the text into chunks of at most max_len characters in one pass. The chunk ends at the last line break,
+    otherwise at the last end of a sentence, otherwise at the last space, otherwise it is cut at max_len.
+    The separator itself is dropped. Code blocks are not split if the chunk can end before them, a code block
+    longer than a chunk is closed at the end of the chunk and opened again in the next one."""
+    fences = code_fences(text)
+    fence_starts = [fence[0] for fence in fences]
+
+    def find_break(low, high):
+        # Each search only looks at the window of the current chunk, so the whole text is scanned about once
+        index = text.rfind("\n", low, high + 1)
+        if index >= 0:
+            return index
+        index = max(text.rfind(sentence_end, low - 1, high + 1) for sentence_end in SENTENCE_ENDS)
+        if index >= 0:
+            return index + 1
+        index = text.rfind(" ", low, high + 1)
+        return index if index >= 0 else None
+
+    def find_fence(index):
+        number = bisect.bisect_right(fence_starts, index) - 1
+        if number >= 0 and fences[number][0] < index < fences[number][1]:
+            return fences[number]
+        return None
 
-        for parse_fn in fn_list:
-            for index in range(max_len, 1, -1):
-                if parse_fn(text, index):
-                    yield text[:index]
-                    text = text[index + 1:]
-                    parsed = True
-                    break
-            if parsed:
-                break
-        if parsed:
+    pos, prefix = 0, ""
+    while len(prefix) + len(text) - pos > max_len:
+        limit = pos + max_len - len(prefix)
+        index = find_break(pos + 2, limit)
+        fence = find_fence(limit if index is None else index)
+        if fence and fence[0] - 1 >= pos + 2:
+            # The chunk ends with the line break before the code block
+            index = fence[0] - 1
+        elif fence and limit - len(FENCE_CLOSING) > pos + 2:
+            limit -= len(FENCE_CLOSING)
+            index = find_break(pos + 2, limit)
+            if index is None:
+                yield prefix + text[pos:limit] + FENCE_CLOSING
+                pos = limit
+            else:
+                yield prefix + text[pos:index] + FENCE_CLOSING
+                pos = index + 1
+            prefix = fence[2] + "\n"
             continue
-        yield text[:max_len]
-        text = text[max_len:]
-
-    yield text
 
+        if index is None:
+            yield prefix + text[pos:limit]
+            pos = limit
+        else:
+            yield prefix + text[pos:index]
+            pos = index + 1
+        prefix = ""
 
-def answer_parser(text, config) -> list:
-
-    def lines_parser(txt, index):
-        return txt[index] == "\n"
-
-    def sentences_parser(txt, index):
-        return txt[index] == " " and txt[index - 1] in ".!?"
-
-    def space_parser(txt, index):
-        return txt[index] == " "
+    yield prefix + text[pos:]
 
-    fn_list = (lines_parser, sentences_parser, space_parser)
 
+def answer_parser(text, config) -> list:
     answer = text.split("\n\n") if config.get('split_paragraphs') else [text]
     split_answer = []
     for answer_part in answer:
-        split_answer.extend([parsed_txt for parsed_txt in message_len_parser(answer_part, config, fn_list)])
+        split_answer.extend(message_len_parser(answer_part, config.get('max_chunk_size')))
     return split_answer
 
 
@@ -384,13 +860,13 @@ async def send_message(message, bot, text: str, markdown_filter, parse_mode=None
         text = text.replace('*', '').replace('`', '')
     try:
         if reply:
-            await message.reply(text, allow_sending_without_reply=True, parse_mode=parse_mode)
+            return await message.reply(text, allow_sending_without_reply=True, parse_mode=parse_mode)
         else:
-            await bot.send_message(message.chat.id, text, message_thread_id=thread_id, parse_mode=parse_mode)
+            return await bot.send_message(message.chat.id, text, message_thread_id=thread_id, parse_mode=parse_mode)
     except exceptions.TelegramBadRequest as e:
         if "can't parse entities" in str(e):
             logging.warning("Telegram could not parse markdown in message, it will be sent without formatting")
-            await send_message(message, bot, text, markdown_filter, parse_mode=None, reply=reply)
+            return await send_message(message, bot, text, markdown_filter, parse_mode=None, reply=reply)
         elif "text must be non-empty" in str(e) or 'message text is empty' in str(e):
             logging.warning(f"Failed to send empty message in chat! Message content: {text}")
         elif "message is too long" in str('e'):
@@ -404,6 +880,86 @@ async def send_message(message, bot, text: str, markdown_filter, parse_mode=None
             await send_message(message, bot, message_too_long, markdown_filter, parse_mode=None, reply=reply)
         else:
             logging.error(traceback.format_exc())
+    return None
+
+
+async def edit_message(sent_message, bot, text: str, markdown_filter, parse_mode=None):
+    if markdown_filter and not parse_mode:
+        text = text.replace('*', '').replace('`', '')
+    try:
+        await bot.edit_message_text(text, chat_id=sent_message.chat.id, message_id=sent_message.message_id,
+                                    parse_mode=parse_mode)
+    except exceptions.TelegramBadRequest as e:
+        if "can't parse entities" in str(e):
+            logging.warning("Telegram could not parse markdown in message, it will be sent without formatting")
+            await edit_message(sent_message, bot, text, markdown_filter, parse_mode=None)
+        elif "message is not modified" not in str(e):
+            logging.error(traceback.format_exc())
+
+
+class AnswerStreamer:
+    """Shows the answer while it is being generated: the first chunk is sent as a reply and then edited,
+    when the text exceeds "max-chunk-size" the next chunk is sent as a new message."""
+
+    # Telegram does not allow to edit messages too often, especially in groups
+    edit_interval = 2
+
+    def __init__(self, message, bot, chat_config):
+        self.message = message
+        self.bot = bot
+        self.chat_config = chat_config
+        self.text = ""
+        self.sent_messages = []
+        self.sent_chunks = []
+        self.last_flush = 0
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def update(self, text):
+        self.text = text
+        if self.flush_task and not self.flush_task.done():
+            return
+        if time.monotonic() - self.last_flush < self.edit_interval:
+            return
+        # Telegram requests are made in the background so as not to slow down reading the stream
+        self.flush_task = asyncio.create_task(self.flush(answer_parser(self.text, self.chat_config)))
+
+    async def flush(self, chunks, parse_mode=None):
+        self.last_flush = time.monotonic()
+        chunks = [chunk for chunk in chunks if chunk.strip()]
+        markdown_filter = self.chat_config.get('markdown_filter')
+        for index, chunk in enumerate(chunks):
+            if index < len(self.sent_messages):
+                if self.sent_chunks[index] != (chunk, parse_mode):
+                    await edit_message(self.sent_messages[index], self.bot, chunk, markdown_filter, parse_mode)
+                    self.sent_chunks[index] = (chunk, parse_mode)
+                continue
+            sent_message = await send_message(self.message, self.bot, chunk, markdown_filter,
+                                              parse_mode=parse_mode, reply=not index)
+            if not sent_message:
+                return
+            self.sent_messages.append(sent_message)
+            self.sent_chunks.append((chunk, parse_mode))
+
+        # The final answer may be shorter than the streamed text if the request was retried
+        for sent_message in self.sent_messages[len(chunks):]:
+            try:
+                await sent_message.delete()
+            except exceptions.TelegramBadRequest as e:
+                logging.error(f'Error deleting message in chat {sent_message.chat.id}\n{e}')
+        del self.sent_messages[len(chunks):]
+        del self.sent_chunks[len(chunks):]
+
+    async def wait(self):
+        if self.flush_task:
+            try:
+                await self.flush_task
+            except Exception as e:
+                logging.error(f'Error editing streamed message\n{e}')
+
+    async def finish(self, chunks, parse_mode=None):
+        """Replaces the streamed text with the final formatted answer."""
+        await self.wait()
+        await self.flush(chunks, parse_mode)
 
 
 async def edit_inline_message(old_txt, service_txt, inline_message_id, full_debug,
@@ -426,13 +982,14 @@ async def edit_inline_message(old_txt, service_txt, inline_message_id, full_debu
             return
 
 
-def token_counter_formatter(answer, total_tokens, input_tokens, output_tokens):
+def token_counter_formatter(answer, total_tokens, input_tokens, output_tokens, cached_tokens=0):
     if not (answer or total_tokens or input_tokens):
         return f'{answer}\n\n---\n⚠️ Счётчик токенов и суммарайзер не работают на этом API.'
+    cached = f', из них {cached_tokens} из кэша' if cached_tokens else ''
     if input_tokens and output_tokens:
-        in_and_out = f' ({input_tokens} запрос, {output_tokens} ответ)'
+        in_and_out = f' ({input_tokens} запрос{cached}, {output_tokens} ответ)'
     elif input_tokens:
-        in_and_out = f' ({input_tokens} запрос)'
+        in_and_out = f' ({input_tokens} запрос{cached})'
     elif output_tokens:
         in_and_out = f' ({output_tokens} ответ)'
     else: